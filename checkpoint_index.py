@@ -0,0 +1,132 @@
+"""
+	Checkpoint manifests and the experiments index
+
+	train.py records every checkpoint it saves in checkpoints.json inside the
+	experiment directory: its epoch, path, size and the metrics of its epoch.
+	The latest checkpoint and the best checkpoint by every metric of each
+	experiment are also kept in index.json next to the experiment directories
+	(experiments/index.json by default). Finding the newest experiment, the
+	latest checkpoint or the best checkpoint by e.g. val_acc then takes a single
+	small read instead of listing and stating directories.
+
+	Experiments without a manifest, or whose manifest points to a removed
+	checkpoint, are resolved by scanning their checkpoints directory.
+"""
+import os
+import json
+import glob
+import time
+import fcntl
+
+MANIFEST = 'checkpoints.json'
+INDEX = 'index.json'
+
+
+# whether value a of a metric is better than value b. Losses are minimized,
+# all other metrics (accuracies) maximized.
+def _is_better(metric, a, b):
+	return a < b if 'loss' in metric else a > b
+
+
+def _read_json(path, default):
+	try:
+		with open(path) as f:
+			return json.load(f)
+	except (OSError, ValueError):
+		return default
+
+
+def _write_json(path, data):
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'w') as f:
+		json.dump(data, f, indent=2)
+	os.replace(tmp_path, path)
+
+
+def record_checkpoint(experiment_dir, checkpoint, epoch, metrics):
+	'''Adds a checkpoint written by train.py to the manifest of its experiment
+	and to the experiments index.'''
+	if not os.path.exists(checkpoint):
+		return
+	entry = {
+		'epoch': epoch,
+		'path': os.path.relpath(checkpoint, experiment_dir),
+		'size': os.path.getsize(checkpoint),
+		'time': time.time(),
+		'metrics': {k: float(v) for k, v in (metrics or {}).items()}
+	}
+
+	manifest_path = os.path.join(experiment_dir, MANIFEST)
+	manifest = _read_json(manifest_path, {'checkpoints': []})
+	manifest['checkpoints'] = [c for c in manifest['checkpoints'] if c['epoch'] != epoch]
+	manifest['checkpoints'].append(entry)
+	_write_json(manifest_path, manifest)
+
+	# several training runs can share the index, so it's updated under a lock
+	index_path = os.path.join(os.path.dirname(os.path.normpath(experiment_dir)), INDEX)
+	with open(index_path + '.lock', 'w') as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		index = _read_json(index_path, {})
+		experiment = index.setdefault(os.path.basename(os.path.normpath(experiment_dir)),
+									  {'best': {}})
+		experiment['latest'] = entry
+		experiment['updated'] = entry['time']
+		for metric, value in entry['metrics'].items():
+			best = experiment['best'].get(metric)
+			if best is None or _is_better(metric, value, best['metrics'][metric]):
+				experiment['best'][metric] = entry
+		_write_json(index_path, index)
+
+
+def _entry_path(experiment_dir, entry):
+	path = os.path.join(experiment_dir, entry['path'])
+	return path if os.path.exists(path) else None
+
+
+def find_checkpoint(experiment_dir, metric=None):
+	'''Returns the path and epoch of the latest checkpoint of an experiment, or
+	of its best checkpoint by metric.'''
+	index_path = os.path.join(os.path.dirname(os.path.normpath(experiment_dir)), INDEX)
+	experiment = _read_json(index_path, {}).get(os.path.basename(os.path.normpath(experiment_dir)))
+	if experiment is not None:
+		entry = experiment['latest'] if metric is None else experiment['best'].get(metric)
+		if entry is not None and _entry_path(experiment_dir, entry):
+			return _entry_path(experiment_dir, entry), entry['epoch']
+
+	# the index is missing or out of date, fall back to the manifest
+	checkpoints = _read_json(os.path.join(experiment_dir, MANIFEST), {'checkpoints': []})['checkpoints']
+	if metric is not None:
+		checkpoints = [c for c in checkpoints if metric in c['metrics']]
+	checkpoints = [c for c in checkpoints if _entry_path(experiment_dir, c)]
+	if len(checkpoints) > 0:
+		if metric is None:
+			entry = max(checkpoints, key=lambda c: c['time'])
+		else:
+			entry = checkpoints[0]
+			for c in checkpoints[1:]:
+				if _is_better(metric, c['metrics'][metric], entry['metrics'][metric]):
+					entry = c
+		return _entry_path(experiment_dir, entry), entry['epoch']
+
+	if metric is not None:
+		raise Exception('Error: no checkpoint of {} has a recorded {}'.format(experiment_dir, metric))
+
+	# experiments trained before manifests were written
+	checkpoint = max(glob.iglob(experiment_dir + '/checkpoints/*.hdf5'), key=os.path.getctime)
+	return checkpoint, int(checkpoint[len(checkpoint) - 8:len(checkpoint) - 5])
+
+
+def latest_experiment(experiments_dir='experiments'):
+	'''Returns the experiment directory in experiments_dir that was checkpointed
+	last, or the most recently modified one if there is no index. Returns None
+	if there are no experiments.'''
+	index = _read_json(os.path.join(experiments_dir, INDEX), {})
+	names = [name for name in index if os.path.isdir(os.path.join(experiments_dir, name))]
+	if len(names) > 0:
+		return os.path.join(experiments_dir, max(names, key=lambda name: index[name]['updated']))
+
+	if not os.path.isdir(experiments_dir):
+		return None
+	dirs_ = [os.path.join(experiments_dir, d) for d in os.listdir(experiments_dir) \
+			 if os.path.isdir(os.path.join(experiments_dir, d))]
+	return max(dirs_, key=os.path.getmtime) if len(dirs_) > 0 else None
@@ -0,0 +1,578 @@
+"""
+	Data-only helpers: midi parsing, piano rolls and pitch indices, training
+	windows and their generators and the instrument family maps. Nothing here
+	imports keras, so data preparation doesn't load a deep learning backend.
+"""
+import os
+import pretty_midi
+import numpy as np
+from collections import defaultdict
+from functools import partial
+from numpy.lib.stride_tricks import as_strided
+from multiprocessing import Pool as ThreadPool
+import json
+
+from dataset import TrackDataset
+from midi_reader import NOTE_DTYPE, NoteTrack, read_midi
+
+NUM_CLASSES = 129  # 0-127 notes + 1 for rests
+
+
+def parse_midi(path):
+	midi = None
+	try:
+		midi = pretty_midi.PrettyMIDI(path)
+		midi.remove_invalid_notes()
+	except Exception as e:
+		raise Exception(("%s\nerror readying midi file %s" % (e, path)))
+	return midi
+
+
+# Reads only the notes of a midi file, much faster than parse_midi. The tracks
+# of the returned midi_reader.NoteMidi can be used in place of pretty_midi
+# instruments to build prepared tracks.
+def parse_midi_notes(path):
+	try:
+		return read_midi(path)
+	except Exception as e:
+		raise Exception(("%s\nerror readying midi file %s" % (e, path)))
+
+
+def get_percent_monophonic(pm_instrument_roll):
+	mask = pm_instrument_roll.T > 0
+	notes = np.sum(mask, axis=1)
+	n = np.count_nonzero(notes)
+	single = np.count_nonzero(notes == 1)
+	if single > 0:
+		return float(single) / float(n)
+	elif single == 0 and n > 0:
+		return 0.0
+	else:  # no notes of any kind
+		return 0.0
+
+
+# Same as get_percent_monophonic(pm_instrument.get_piano_roll(fs)), but computed
+# from the note start and end times instead of a dense roll.
+def get_notes_percent_monophonic(pm_instrument, fs=100):
+	if _roll_alters_notes(pm_instrument):
+		return get_percent_monophonic(pm_instrument.get_piano_roll(fs=fs))
+	notes, _ = _sweep_notes(pm_instrument, fs)
+	n = np.count_nonzero(notes)
+	single = np.count_nonzero(notes == 1)
+	return float(single) / float(n) if single > 0 else 0.0
+
+
+# pitch bends and sustain pedals smear notes over the piano roll of an
+# instrument, such rolls can't be derived from the notes alone
+def _roll_alters_notes(pm_instrument):
+	if isinstance(pm_instrument, NoteTrack):
+		return pm_instrument.alters_roll
+	return not pm_instrument.is_drum and \
+		   (any(np.abs(b.pitch) >= 1 for b in pm_instrument.pitch_bends) or
+			any(c.number == 64 and c.value >= 64 for c in pm_instrument.control_changes))
+
+
+# Returns the number of distinct pitches sounding at every step of the piano
+# roll of pm_instrument at fs, and the sum of those pitches. Both are computed
+# with a sweep over the start and end steps of the notes.
+def _sweep_notes(pm_instrument, fs):
+	num_steps = int(fs * pm_instrument.get_end_time()) if len(pm_instrument.notes) > 0 else 0
+	if isinstance(pm_instrument, NoteTrack):
+		notes = pm_instrument.notes
+	else:
+		notes = np.array([(n.pitch, n.velocity, n.start, n.end) for n in pm_instrument.notes],
+						 dtype=NOTE_DTYPE)
+	notes = notes[notes['velocity'] > 0] if not pm_instrument.is_drum else notes[:0]
+	if len(notes) == 0:
+		return np.zeros(num_steps, dtype=np.int64), np.zeros(num_steps, dtype=np.int64)
+	pitches = notes['pitch'].astype(np.int64)
+	starts = np.minimum((notes['start'] * fs).astype(np.int64), num_steps)
+	ends = np.minimum((notes['end'] * fs).astype(np.int64), num_steps)
+
+	# merge overlapping notes of the same pitch: sorted by pitch and start on
+	# one axis, every note only covers the steps after the ends of the notes
+	# before it
+	order = np.lexsort((starts, pitches))
+	pitches = pitches[order]
+	offset = pitches * (num_steps + 1)
+	starts, ends = starts[order] + offset, ends[order] + offset
+	covered = np.maximum.accumulate(ends)
+	starts[1:] = np.maximum(starts[1:], covered[:-1])
+	ends = np.maximum(ends, starts)
+	starts, ends = starts - offset, ends - offset
+
+	def _sweep(weights=None):
+		changes = np.bincount(starts, weights, minlength=num_steps + 1) - \
+				  np.bincount(ends, weights, minlength=num_steps + 1)
+		return np.cumsum(changes[:num_steps]).astype(np.int64)
+
+	return _sweep(), _sweep(pitches)
+
+
+def filter_monophonic(pm_instruments, percent_monophonic=0.99):
+	return [i for i in pm_instruments if \
+			get_notes_percent_monophonic(i) >= percent_monophonic]
+
+
+# load data from prepared datset containing instrument tracks (a list of track
+# dicts or a dataset.TrackDataset). All windows are indexed once (or the
+# window_index of build_window_index is passed in), every pass over the data
+# draws its batches from a new random order of that index.
+def get_prepared_data_generator(all_tracks, window_size=20, batch_size=32,
+					   use_instrument=False, ignore_empty=False, encode_section=False,
+					   sparse=False, window_index=None):
+	if window_index is None:
+		window_index = build_window_index(all_tracks, window_size, ignore_empty)
+	window_track, window_pos = window_index
+	track_instruments, track_num_windows = get_track_window_counts(all_tracks, window_size)
+
+	while True:
+		order = np.random.permutation(len(window_pos))
+		for batch_index in range(0, len(order) - batch_size + 1, batch_size):
+			batch = order[batch_index:batch_index + batch_size]
+			X, y = gather_track_windows(all_tracks, window_track[batch], window_pos[batch], window_size)
+			instruments, sections = get_window_conditioning(track_instruments, track_num_windows,
+															window_track[batch], window_pos[batch])
+			yield _expand_windows(X, y, instruments, sections,
+								  use_instrument, encode_section, sparse)
+
+
+# load data with a lazzy loader
+def get_data_generator(midi_paths,
+					   window_size=20,
+					   batch_size=32,
+					   num_threads=8,
+					   use_instrument=False,
+					   ignore_empty=False,
+					   encode_section=False,
+					   max_files_in_ram=170,
+					   sparse=False,
+					   cache=None):
+	# load midi data. Even a single worker parses the next chunk of files while
+	# the current one is consumed.
+	pool = ThreadPool(max(num_threads, 1))
+
+	load_tracks = partial(_load_midi_tracks, window_size=window_size, cache=cache)
+
+	def _chunk(load_index):
+		return midi_paths[load_index:load_index + max_files_in_ram]
+
+	load_index = 0
+	pending = pool.map_async(load_tracks, _chunk(load_index))
+	leftover = None
+
+	# the workers are stopped when the generator is closed or garbage collected
+	try:
+		while True:
+			# print('loading large batch: {}'.format(max_files_in_ram))
+			# print('Parsing midi files...')
+			# start_time = time.time()
+			parsed = pending.get()
+			# every pass over the files starts with the first chunk
+			load_index = load_index + max_files_in_ram
+			if load_index >= len(midi_paths):
+				load_index = 0
+
+			# the workers already parse the next chunk while this one is consumed
+			pending = pool.map_async(load_tracks, _chunk(load_index))
+
+			# print('Finished in {:.2f} seconds'.format(time.time() - start_time))
+			# print('parsed, now extracting data')
+			tracks = [track for file_tracks in parsed for track in file_tracks]
+			data = _window_index_from_tracks(tracks, window_size, ignore_empty)
+			leftover = yield from _batches_from_window_index(data, window_size, batch_size,
+															 use_instrument, encode_section,
+															 sparse, leftover)
+
+			# probably unneeded but why not
+			del parsed  # free the mem
+			del data  # free the mem
+	finally:
+		pool.terminate()
+
+
+# exact number of windows get_data_generator yields from one pass over midi
+# files. Files are counted one at a time in the workers and only their counts
+# are kept. Without a cache this parses every file once more, with a
+# roll_cache.RollCache it fills the cache that the generator then reads from.
+def count_midi_windows(midi_paths, window_size, ignore_empty=False, num_threads=1, cache=None):
+	count = partial(_count_midi_windows, window_size=window_size, ignore_empty=ignore_empty,
+					cache=cache)
+	if num_threads > 1:
+		pool = ThreadPool(num_threads)
+		try:
+			return sum(pool.imap_unordered(count, midi_paths, chunksize=4))
+		finally:
+			pool.close()
+	return sum(map(count, midi_paths))
+
+
+def _count_midi_windows(path, window_size, ignore_empty=False, cache=None):
+	tracks = _load_midi_tracks(path, window_size, cache)
+	return len(build_window_index(tracks, window_size, ignore_empty)[1])
+
+
+# parse midi files into the prepared tracks of their monophonic instruments
+def load_midi_tracks(midi_paths, window_size, num_threads=1, cache=None):
+	load_tracks = partial(_load_midi_tracks, window_size=window_size, cache=cache)
+	if num_threads > 1:
+		pool = ThreadPool(num_threads)
+		parsed = pool.map(load_tracks, midi_paths)
+		pool.close()
+	else:
+		parsed = map(load_tracks, midi_paths)
+	return [track for file_tracks in parsed for track in file_tracks]
+
+
+# parse a midi file into the tracks of its monophonic instruments. Only the
+# compact tracks are sent back from the worker processes, not the parsed midi.
+# Only the notes are read, unless pitch bends or sustain pedals require pretty_midi.
+# With a roll_cache.RollCache, files are only parsed if they aren't cached yet.
+def _load_midi_tracks(path, window_size, cache=None):
+	if cache is not None:
+		return cache.load_tracks(path, window_size, _load_midi_tracks)
+	midi = parse_midi_notes(path)
+	if any(_roll_alters_notes(i) for i in midi.instruments):
+		midi = parse_midi(path)
+	return _tracks_from_monophonic_instruments([midi], window_size)
+
+
+# create a midi instrument using the one-hot encoding output of keras model.predict.
+def _network_output_to_instrument(windows,
+							instrument_program=0,
+							allow_represses=False):
+	# Create an Instrument instance
+	instrument = pretty_midi.Instrument(program=instrument_program)
+
+	cur_note = None  # an invalid note to start with
+	cur_note_start = None
+	clock = 0
+
+	# Iterate over note names, which will be converted to note number later
+	for step in windows:
+
+		note_num = np.argmax(step) - 1
+
+		# a note has changed
+		if allow_represses or note_num != cur_note:
+
+			# if a note has been played before and it wasn't a rest
+			if cur_note is not None and cur_note >= 0:
+				# add the last note, now that we have its end time
+				note = pretty_midi.Note(velocity=127,
+										pitch=int(cur_note),
+										start=cur_note_start,
+										end=clock)
+				instrument.notes.append(note)
+
+			# update the current note
+			cur_note = note_num
+			cur_note_start = clock
+
+		# update the clock
+		clock = clock + 1.0 / 4
+
+	return instrument
+
+# create a pretty midi file with a single instrument using the one-hot encoding
+# output of keras model.predict.
+def _network_output_to_midi(windows,
+							instrument_name=None,
+							instrument_program=None,
+							allow_represses=False):
+	# Create a PrettyMIDI object
+	midi = pretty_midi.PrettyMIDI()
+	# Create an Instrument instance
+
+	if instrument_program is None and instrument_name is None:
+		instrument_program = 0
+	elif instrument_program is not None:
+		pass
+	elif instrument_name is not None:
+		instrument_program = pretty_midi.instrument_name_to_program(instrument_name)
+	instrument = _network_output_to_instrument(windows, instrument_program)
+
+	# Add the instrument to the PrettyMIDI object
+	midi.instruments.append(instrument)
+	return midi
+
+
+# Read instruments (map program id to instrument family) from the
+# instruments.json next to this file, once they are first needed
+_instrument_families = None
+
+
+def _get_instrument_families():
+	global _instrument_families
+	if _instrument_families is None:
+		instruments = defaultdict(lambda: 0)  # Default = 0 (piano)
+		families = []
+		family_instruments = []
+		with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instruments.json')) as json_file:
+			data = json.load(json_file)
+			for instrument in data:
+				instrument_id = int(instrument['hexcode'], 16)
+				if instrument['family'] in families:
+					fam_id = families.index(instrument['family'])
+				else:
+					fam_id = len(families)
+					family_instruments.append(instrument_id)
+					families.append(instrument['family'])
+				instruments[instrument_id] = fam_id
+		_instrument_families = instruments, families, family_instruments
+	return _instrument_families
+
+
+def get_family_id_by_instrument_normalized(instrument_id):
+	instruments, families, _ = _get_instrument_families()
+	return instruments[instrument_id] / len(families)
+
+
+def get_family_instrument_by_normalized_class(normalized_class):
+	_, families, family_instruments = _get_instrument_families()
+	fam_id = int(normalized_class * len(families))
+	return family_instruments[fam_id]
+
+
+# returns prepared tracks (see prep_data_pickle.py) of all monophonic
+# instruments in pretty midi files
+def _tracks_from_monophonic_instruments(midi, window_size):
+	tracks = []
+	for m in midi:
+		if m is not None:
+			melody_instruments = filter_monophonic(m.instruments, 1.0)
+			for instrument in melody_instruments:
+				if len(instrument.notes) > window_size:
+					tracks.append({
+						'indices': get_instrument_indices(instrument),
+						'instrument': get_family_id_by_instrument_normalized(instrument.program)
+					})
+	return tracks
+
+
+# The instrument group and the number of windows of every track in a collection
+# of tracks (a list of prepared tracks or a dataset.TrackDataset)
+def get_track_window_counts(tracks, window_size):
+	if isinstance(tracks, TrackDataset):
+		lengths = tracks.lengths().astype(np.int64)
+		instruments = tracks.instruments()
+	else:
+		lengths = np.array([len(get_track_indices(t)) for t in tracks], dtype=np.int64)
+		instruments = np.array([t['instrument'] for t in tracks], dtype=np.float32)
+	return instruments, np.maximum(lengths - window_size - 1, 0)
+
+
+# Index all windows in a collection of tracks without materializing them.
+# Returns the track number and the start position within that track of every
+# window. The target of a window is the step at start + window_size + 1.
+def build_window_index(tracks, window_size, ignore_empty=False):
+	_, num_windows = get_track_window_counts(tracks, window_size)
+
+	# window number i within its own track, for every window of every track
+	window_track = np.repeat(np.arange(len(num_windows), dtype=np.int32), num_windows)
+	window_pos = (np.arange(num_windows.sum()) -
+				  np.repeat(np.cumsum(num_windows) - num_windows, num_windows)).astype(np.int32)
+
+	if ignore_empty:
+		# Window only contains pauses and Y is also a pause.. ignore!
+		empty = [_empty_windows(get_track_indices(tracks[t]), np.arange(n), window_size)
+				 for t, n in enumerate(num_windows) if n > 0]
+		keep = ~np.concatenate(empty) if len(empty) > 0 else np.zeros(0, dtype=bool)
+		window_track, window_pos = window_track[keep], window_pos[keep]
+
+	return window_track, window_pos
+
+
+# The instrument group and the track section (try to model intro, chorus, outro,
+# etc) of windows of a window index, from the per track values of
+# get_track_window_counts. Only computed for a batch at a time, so the index
+# itself stays at two integers per window.
+def get_window_conditioning(track_instruments, track_num_windows, window_track, window_pos):
+	sections = window_pos.astype(np.int64) * 4 // track_num_windows[window_track]
+	return track_instruments[window_track], sections.astype(np.uint8)
+
+
+# materialize the X, y pitch index windows at the given track numbers and start
+# positions of a window index, see build_window_index
+def gather_track_windows(tracks, window_track, window_pos, window_size):
+	if isinstance(tracks, TrackDataset):
+		# gather straight from the memory mapped events of all tracks
+		starts = tracks.offsets(window_track) + window_pos
+		return _gather_windows(tracks.events, starts, window_size)
+
+	X = np.empty((len(window_pos), window_size), dtype=np.uint8)
+	y = np.empty(len(window_pos), dtype=np.uint8)
+	for i, (t, pos) in enumerate(zip(window_track, window_pos)):
+		indices = get_track_indices(tracks[t])
+		X[i] = indices[pos:pos + window_size]
+		y[i] = indices[pos + window_size + 1]
+	return X, y
+
+
+# Index all windows of a chunk of tracks. Returns the pitch indices of all
+# tracks concatenated into a single events array together with the start of
+# every window in it and the instrument group and track section of every window.
+def _window_index_from_tracks(tracks, window_size, ignore_empty=False):
+	window_track, window_pos = build_window_index(tracks, window_size, ignore_empty)
+	track_instruments, track_num_windows = get_track_window_counts(tracks, window_size)
+	instruments, sections = get_window_conditioning(track_instruments, track_num_windows,
+													window_track, window_pos)
+
+	rolls = [get_track_indices(t) for t in tracks]
+	if len(rolls) == 0:
+		return np.zeros(0, dtype=np.uint8), window_pos.astype(np.int64), instruments, sections
+	events = np.concatenate(rolls).astype(np.uint8, copy=False)
+	lengths = np.array([len(r) for r in rolls], dtype=np.int64)
+	track_starts = np.cumsum(lengths) - lengths
+
+	starts = track_starts[window_track] + window_pos
+	return events, starts, instruments, sections
+
+
+# mask of the windows that only contain rests and have a rest as target
+def _empty_windows(events, starts, window_size):
+	notes = np.concatenate(([0], np.cumsum(events != 0)))
+	notes_in_window = notes[starts + window_size] - notes[starts]
+	return (notes_in_window == 0) & (events[starts + window_size + 1] == 0)
+
+
+# The windows of a chunk that didn't fill a batch, as X, y, instruments and
+# sections. They are carried into the first batch of the next chunk.
+def _no_leftover(window_size):
+	return (np.zeros((0, window_size), dtype=np.uint8), np.zeros(0, dtype=np.uint8),
+			np.zeros(0, dtype=np.float32), np.zeros(0, dtype=np.uint8))
+
+
+# yields X, y batches from a window index, see _window_index_from_tracks,
+# starting with the leftover windows of the previous chunk. Returns the windows
+# of this chunk that don't fill a batch, so that every window of a pass over
+# the files is used and a pass yields (number of windows) / batch_size batches.
+def _batches_from_window_index(data, window_size, batch_size, use_instrument=False,
+							   encode_section=False, sparse=False, leftover=None):
+	events, starts, instruments, sections = data
+	if leftover is None:
+		leftover = _no_leftover(window_size)
+
+	# fill up the leftover windows first
+	batch_index = min(batch_size - len(leftover[0]), len(starts))
+	X, y = _gather_windows(events, starts[:batch_index], window_size)
+	leftover = (np.concatenate([leftover[0], X]), np.concatenate([leftover[1], y]),
+				np.concatenate([leftover[2], instruments[:batch_index]]),
+				np.concatenate([leftover[3], sections[:batch_index]]))
+	if len(leftover[0]) < batch_size:
+		return leftover
+	yield _expand_windows(*leftover, use_instrument=use_instrument,
+						  encode_section=encode_section, sparse=sparse)
+
+	while batch_index + batch_size <= len(starts):
+		batch = slice(batch_index, batch_index + batch_size)
+		X, y = _gather_windows(events, starts[batch], window_size)
+		yield _expand_windows(X, y, instruments[batch], sections[batch],
+							  use_instrument, encode_section, sparse)
+		batch_index = batch_index + batch_size
+
+	rest = slice(batch_index, None)
+	X, y = _gather_windows(events, starts[rest], window_size)
+	return X, y, instruments[rest], sections[rest]
+
+
+# materialize the windows starting at the given offsets of a sequence of events
+def _gather_windows(events, starts, window_size):
+	return _sliding_windows(events, window_size)[starts], events[starts + window_size + 1]
+
+
+# zero copy view of all windows of window_size steps along the first axis of
+# arr. Row i of the result is arr[i:i + window_size].
+def _sliding_windows(arr, window_size):
+	num_windows = max(arr.shape[0] - window_size + 1, 0)
+	return as_strided(arr, shape=(num_windows, window_size) + arr.shape[1:],
+					  strides=(arr.strides[0],) + arr.strides, writeable=False)
+
+
+# expand compact pitch index windows into the one-hot network input and output,
+# or into the integer input and sparse targets of embedding models
+def _expand_windows(X, y, instruments, sections, use_instrument=False, encode_section=False,
+					sparse=False):
+	x_vals = _encode_input(X, instruments, sections, use_instrument, encode_section, sparse)
+	if sparse:
+		return x_vals, y.astype(np.int32)[:, np.newaxis]
+	return x_vals, indices_to_roll(y, dtype=np.float32)
+
+
+# Build the network input for a batch of pitch index windows. The
+# conditioning features of a window are broadcast over its steps while
+# filling a single preallocated array, so nothing is replicated per window.
+# Embedding models (sparse=True) get the pitch indices and the conditioning
+# features as separate inputs.
+def _encode_input(X, instruments=None, sections=None, use_instrument=False, encode_section=False,
+				  sparse=False):
+	conditioning = _encode_conditioning(instruments, sections, use_instrument, encode_section)
+
+	if sparse:
+		X = X.astype(np.int32)
+		return X if conditioning is None else [X, conditioning]
+
+	num_extra = 0 if conditioning is None else conditioning.shape[1]
+	batch_size, window_size = X.shape
+	x_vals = np.zeros((batch_size, window_size, num_extra + NUM_CLASSES), dtype=np.float32)
+	x_vals[np.arange(batch_size)[:, np.newaxis], np.arange(window_size), num_extra + X] = 1
+	if conditioning is not None:
+		x_vals[:, :, :num_extra] = conditioning[:, np.newaxis, :]
+	return x_vals
+
+
+# The conditioning features of a batch of windows: 4 one-hot track section
+# inputs (try to model intro, chorus, outro, etc) followed by the instrument
+# class (normalized to 0>1)
+def _encode_conditioning(instruments, sections, use_instrument=False, encode_section=False):
+	columns = []
+	if encode_section:
+		columns.append(indices_to_roll(np.asarray(sections), num_classes=4, dtype=np.float32))
+	if use_instrument:
+		columns.append(np.asarray(instruments, dtype=np.float32)[:, np.newaxis])
+	if len(columns) == 0:
+		return None
+	return np.concatenate(columns, axis=1)
+
+
+# sliding windows of the pitch indices of a pretty midi instrument.
+# Returns X, y as views of the track.
+def _encode_sliding_windows(pm_instrument, window_size):
+	track = get_instrument_indices(pm_instrument)
+	return _sliding_windows(track[:-2], window_size), track[window_size + 1:]
+
+
+# This approach uses the piano roll method, where each step in the sliding
+# window represents a constant unit of time (fs=4, or 1 sec / 4 = 250ms).
+# This allows us to encode rests. Each step holds a single uint8, the index of
+# the active class of the one-hot network input (0 for rests, note + 1
+# otherwise). Steps without exactly one note are rests. The notes are
+# rasterized straight into the indices, without a piano roll.
+def get_instrument_indices(pm_instrument, fs=4):
+	if _roll_alters_notes(pm_instrument):
+		roll = pm_instrument.get_piano_roll(fs=fs).T > 0
+		notes, pitches = np.sum(roll, axis=1), np.argmax(roll, axis=1)
+	else:
+		# where a single note sounds, the sum of the pitches is its pitch
+		notes, pitches = _sweep_notes(pm_instrument, fs)
+	indices = np.where(notes == 1, pitches + 1, 0).astype(np.uint8)
+
+	# trim beginning silence
+	return indices[np.argmax(notes > 0):] if len(indices) > 0 else indices
+
+
+def roll_to_indices(roll):
+	return np.argmax(roll, axis=1).astype(np.uint8)
+
+
+# one-hot expand an array of class indices along a new last axis
+def indices_to_roll(indices, num_classes=NUM_CLASSES, dtype=float):
+	return np.eye(num_classes, dtype=dtype)[indices]
+
+
+# pitch indices of a prepared track, converting tracks of older datasets which
+# stored the full one-hot roll
+def get_track_indices(track):
+	if 'indices' in track:
+		return track['indices']
+	return roll_to_indices(track['roll'])
@@ -0,0 +1,275 @@
+"""
+	Memory mapped dataset of prepared instrument tracks
+
+	A prepared dataset is a directory holding
+		events.bin  - the pitch indices (see data_utils.get_instrument_indices) of all
+		              tracks, stored back to back as one contiguous uint8 array
+		index-*.npy - one row per track with its offset and length in events.bin,
+		              its normalized instrument family and the id of its source file
+		meta.json   - format version, the name of the current index file, the
+		              committed size of events.bin, the list of source file paths
+		              and a manifest of all processed files
+
+	Both arrays are opened with numpy memmap, so opening a dataset takes constant
+	time and all training runs on the same host share one page cached copy.
+
+	Writers only ever append to events.bin and commit by atomically replacing
+	meta.json, which points to a new index file. Readers and interrupted writers
+	therefore always see the tracks of the last commit. The index file of the
+	previous commit is kept, so a reader that read meta.json just before a commit
+	can still open the index it points to.
+"""
+import os
+import json
+import pickle
+import random
+from collections.abc import Sequence
+
+import numpy as np
+
+FORMAT_VERSION = 2
+
+INDEX_DTYPE = np.dtype([('offset', '<i8'),
+						('length', '<i4'),
+						('instrument', '<f4'),
+						('source', '<i4')])
+
+
+def is_dataset_dir(path):
+	return os.path.isfile(os.path.join(path, 'meta.json'))
+
+
+class TrackDataset(Sequence):
+	'''Read-only view of the tracks of a prepared dataset directory. Tracks are
+	returned as dicts like the ones stored in legacy pickle datasets, their
+	'indices' are zero copy slices of the memory mapped events.'''
+
+	def __init__(self, path, ids=None, _arrays=None):
+		self.path = path
+		if _arrays is None:
+			_arrays = _open_arrays(path)
+		self._arrays = _arrays
+		self.events, self.index, meta = _arrays
+		self.sources = meta['sources']
+		if ids is None:
+			ids = np.arange(len(self.index))
+		self.ids = np.asarray(ids, dtype=np.int64)
+
+	def __len__(self):
+		return len(self.ids)
+
+	def __getitem__(self, i):
+		if isinstance(i, slice):
+			return self.take(self.ids[i])
+		row = self.index[self.ids[i]]
+		offset, length = int(row['offset']), int(row['length'])
+		return {
+			'indices': self.events[offset:offset + length],
+			'instrument': float(row['instrument']),
+			'source': self.sources[row['source']]
+		}
+
+	# a dataset restricted to (and ordered by) the given track ids
+	def take(self, ids):
+		return TrackDataset(self.path, ids=ids, _arrays=self._arrays)
+
+	def shuffled(self):
+		return self.take(np.random.permutation(self.ids))
+
+	def lengths(self):
+		return self.index['length'][self.ids]
+
+	def instruments(self):
+		return self.index['instrument'][self.ids]
+
+	# offsets into events of the tracks at the given positions of this dataset
+	def offsets(self, positions):
+		return self.index['offset'][self.ids[positions]]
+
+	# only the path and the track ids are sent to other processes, which map
+	# the dataset themselves
+	def __getstate__(self):
+		return {'path': self.path, 'ids': self.ids}
+
+	def __setstate__(self, state):
+		self.__init__(state['path'], ids=state['ids'])
+
+
+def _open_arrays(path):
+	meta = _read_meta(path)
+	index = np.load(os.path.join(path, meta['index']), mmap_mode='r')
+	events_path = os.path.join(path, 'events.bin')
+	if os.path.getsize(events_path) > 0:
+		events = np.memmap(events_path, dtype=np.uint8, mode='r')
+	else:  # empty files can't be memory mapped
+		events = np.zeros(0, dtype=np.uint8)
+	return events, index, meta
+
+
+def _read_meta(path):
+	with open(os.path.join(path, 'meta.json')) as f:
+		meta = json.load(f)
+	if meta['version'] == 1:
+		# the first version had a single index.npy and no manifest
+		meta.update({'index': 'index.npy', 'generation': 0, 'files': {}})
+	elif meta['version'] != FORMAT_VERSION:
+		raise Exception('Error: unsupported dataset version {} in {}'
+						.format(meta['version'], path))
+	return meta
+
+
+class DatasetWriter(object):
+	'''Appends tracks to a (new or existing) prepared dataset directory. Added
+	tracks become visible to readers on commit() (and close()). Opening a dataset
+	drops the events an interrupted writer appended after its last commit.
+
+	files is a manifest of processed source files that is committed together with
+	the tracks, see prep_data_pickle.py.'''
+
+	def __init__(self, path):
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+
+		self.rows = []
+		self.sources = []
+		self.files = {}
+		self.generation = 0
+		self.index_name = None
+		events_path = os.path.join(path, 'events.bin')
+		end = 0
+		if is_dataset_dir(path):
+			meta = _read_meta(path)
+			index = np.load(os.path.join(path, meta['index']))
+			self.rows = [tuple(row) for row in index]
+			self.sources = list(meta['sources'])
+			self.files = _complete_manifest(meta['files'], index, self.sources)
+			self.generation = meta['generation']
+			self.index_name = meta['index']
+			if 'events_size' in meta:
+				end = meta['events_size']
+			elif len(index) > 0:
+				# datasets committed before events_size was stored
+				end = int(np.max(index['offset'].astype(np.int64) + index['length']))
+		self._source_ids = {s: i for i, s in enumerate(self.sources)}
+
+		self.events_file = open(events_path, 'ab')
+		self.events_file.truncate(end)
+		self.offset = end
+
+	def add_track(self, indices, instrument, source):
+		indices = np.ascontiguousarray(indices, dtype=np.uint8)
+		if source not in self._source_ids:
+			self._source_ids[source] = len(self.sources)
+			self.sources.append(source)
+
+		self.events_file.write(indices.tobytes())
+		self.rows.append((self.offset, len(indices), instrument, self._source_ids[source]))
+		self.offset += len(indices)
+
+	# drop the tracks of a source file. Its events stay in events.bin, but are
+	# no longer referenced by the index.
+	def remove_source(self, source):
+		source_id = self._source_ids.get(source)
+		if source_id is not None:
+			self.rows = [row for row in self.rows if row[3] != source_id]
+
+	def commit(self):
+		self.events_file.flush()
+		os.fsync(self.events_file.fileno())
+
+		self.generation += 1
+		index_name = 'index-{:06d}.npy'.format(self.generation)
+		_write_atomic(os.path.join(self.path, index_name),
+					  lambda f: np.save(f, np.array(self.rows, dtype=INDEX_DTYPE)))
+		_write_atomic(os.path.join(self.path, 'meta.json'),
+					  lambda f: f.write(json.dumps({
+						  'version': FORMAT_VERSION,
+						  'generation': self.generation,
+						  'index': index_name,
+						  # removed sources leave unreferenced events behind, so the
+						  # end of the committed events can't be derived from the index
+						  'events_size': self.offset,
+						  'sources': self.sources,
+						  'files': self.files
+					  }).encode('utf-8')))
+
+		# keep the index of the previous commit for readers that are about to
+		# open it (readers that opened an index keep their mapping of it), and
+		# drop all older ones
+		for name in os.listdir(self.path):
+			if name.startswith('index') and name.endswith('.npy') and \
+					name not in (index_name, self.index_name):
+				os.remove(os.path.join(self.path, name))
+		self.index_name = index_name
+
+	def close(self):
+		self.commit()
+		self.events_file.close()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+# The manifest of a dataset with an entry for every source that has tracks.
+# Datasets of the first version and converted pickles have tracks without a
+# manifest entry; their entries only hold the number of tracks and, having no
+# content hash, are treated as changed by prep_data_pickle.py.
+def _complete_manifest(files, index, sources):
+	files = dict(files)
+	source_ids, counts = np.unique(index['source'], return_counts=True)
+	for source_id, count in zip(source_ids, counts):
+		files.setdefault(sources[source_id], {'tracks': int(count)})
+	return files
+
+
+def _write_atomic(path, write):
+	tmp_path = path + '.tmp'
+	with open(tmp_path, 'wb') as f:
+		write(f)
+		f.flush()
+		os.fsync(f.fileno())
+	os.replace(tmp_path, path)
+
+
+# load prepared tracks from a dataset directory or a legacy pickle file
+def load_tracks(path, shuffle=False):
+	if os.path.isdir(path):
+		tracks = TrackDataset(path)
+		return tracks.shuffled() if shuffle else tracks
+
+	import data_utils
+	with open(path, 'rb') as f:
+		tracks = pickle.load(f)
+	for track in tracks:
+		if 'indices' not in track:
+			# older pickles hold the one-hot roll of every track
+			track['indices'] = data_utils.get_track_indices(track)
+			del track['roll']
+	if shuffle:
+		random.shuffle(tracks)
+	return tracks
+
+
+# convert a legacy pickle dataset into a prepared dataset directory
+def convert_pickle(pickle_file, path):
+	import data_utils
+	with open(pickle_file, 'rb') as f:
+		tracks = pickle.load(f)
+	with DatasetWriter(path) as writer:
+		for track in tracks:
+			writer.add_track(data_utils.get_track_indices(track), track['instrument'],
+							 track.get('source', pickle_file))
+
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description='Convert a pickle dataset created by an '
+												 'older prep_data_pickle.py into a dataset directory.')
+	parser.add_argument('pickle_file', type=str)
+	parser.add_argument('dataset_dir', type=str)
+	args = parser.parse_args()
+	convert_pickle(args.pickle_file, args.dataset_dir)
@@ -0,0 +1,233 @@
+"""
+	Lightweight note-only midi reader for the data pipeline
+
+	pretty_midi builds an object for every note, control change, pitch bend,
+	lyric and text event of a file, while preparing tracks only needs the notes
+	and the program of every instrument. read_midi reads just those into compact
+	arrays. Instruments are split by program, channel and track, invalid notes
+	are dropped and ticks are converted to seconds through the tempo map of the
+	first track, all exactly like pretty_midi does. The returned tracks can be
+	used by the track builders in data_utils in place of pretty_midi instruments.
+
+	Pitch bends and sustain pedals change the piano roll of an instrument beyond
+	its notes, tracks that have them are marked with alters_roll. Files with such
+	tracks still have to be parsed by pretty_midi (see data_utils._load_midi_tracks).
+
+	Run this module on a directory of midi files to check that it reads the same
+	notes as pretty_midi.
+"""
+from collections import defaultdict
+
+import mido
+import numpy as np
+
+# files with a larger tick are rejected as corrupt, like pretty_midi does
+MAX_TICK = 1e7
+
+NOTE_DTYPE = np.dtype([('pitch', 'u1'),
+					   ('velocity', 'u1'),
+					   ('start', '<f8'),
+					   ('end', '<f8')])
+
+
+class NoteMidi(object):
+	'''The note tracks of a midi file, in place of a pretty_midi.PrettyMIDI'''
+
+	def __init__(self, instruments):
+		self.instruments = instruments
+
+
+class NoteTrack(object):
+	'''The notes of one instrument of a midi file, in place of a
+	pretty_midi.Instrument. notes is an array of NOTE_DTYPE.'''
+
+	def __init__(self, program, is_drum, notes, controls_end_time=None, alters_roll=False):
+		self.program = program
+		self.is_drum = is_drum
+		self.notes = notes
+		self.controls_end_time = controls_end_time
+		self.alters_roll = alters_roll and not is_drum
+
+	# time of the last note end, pitch bend or control change of the instrument
+	def get_end_time(self):
+		events = [self.notes['end'].max()] if len(self.notes) > 0 else []
+		if self.controls_end_time is not None:
+			events.append(self.controls_end_time)
+		return float(max(events)) if len(events) > 0 else 0.
+
+
+# The pitch bends and control changes of an instrument are only kept as their
+# last tick and whether they alter the piano roll. Like the event lists in
+# pretty_midi, one _Controls can be shared by several instruments.
+class _Controls(object):
+
+	def __init__(self):
+		self.last_tick = None
+		self.alters_roll = False
+
+	def add(self, tick, alters_roll):
+		self.last_tick = tick if self.last_tick is None else max(self.last_tick, tick)
+		self.alters_roll = self.alters_roll or alters_roll
+
+
+class _TempoMap(object):
+
+	def __init__(self, midi_data):
+		resolution = midi_data.ticks_per_beat
+		# only the first track is searched for tempo changes, see
+		# pretty_midi.PrettyMIDI._load_tempo_changes
+		tick_scales = [(0, 60.0 / (120.0 * resolution))]
+		tick = 0
+		for event in midi_data.tracks[0]:
+			tick += event.time
+			if event.type == 'set_tempo':
+				if tick == 0:
+					bpm = 6e7 / event.tempo
+					tick_scales = [(0, 60.0 / (bpm * resolution))]
+				else:
+					_, last_tick_scale = tick_scales[-1]
+					tick_scale = 60.0 / ((6e7 / event.tempo) * resolution)
+					if tick_scale != last_tick_scale:
+						tick_scales.append((tick, tick_scale))
+
+		# the time at the start of every tempo, accumulated the same way as the
+		# tick to time array of pretty_midi.PrettyMIDI._update_tick_to_time
+		self.ticks = np.array([t for t, _ in tick_scales], dtype=np.int64)
+		self.scales = np.array([s for _, s in tick_scales])
+		self.times = np.zeros(len(tick_scales))
+		for i in range(1, len(tick_scales)):
+			self.times[i] = self.times[i - 1] + \
+							self.scales[i - 1] * (self.ticks[i] - self.ticks[i - 1])
+
+	def to_time(self, ticks):
+		ticks = np.asarray(ticks, dtype=np.int64)
+		tempo = np.searchsorted(self.ticks, ticks, side='right') - 1
+		return self.times[tempo] + self.scales[tempo] * (ticks - self.ticks[tempo])
+
+
+def read_midi(path):
+	midi_data = mido.MidiFile(path)
+
+	max_tick = max([sum(e.time for e in track) for track in midi_data.tracks]) + 1
+	if max_tick > MAX_TICK:
+		raise ValueError(('MIDI file has a largest tick of {},'
+						  ' it is likely corrupt'.format(max_tick)))
+	tempo_map = _TempoMap(midi_data)
+
+	# instruments by (program, channel, track) as [notes, controls], with
+	# notes as a list of (pitch, velocity, start tick, end tick)
+	instruments = {}
+	# controls of a (channel, track) that appeared before its first note,
+	# see pretty_midi.PrettyMIDI._load_instruments
+	stragglers = {}
+
+	def _get_instrument(program, channel, track, create_new):
+		key = (program, channel, track)
+		if key in instruments:
+			return instruments[key]
+		if not create_new and (channel, track) in stragglers:
+			return stragglers[(channel, track)]
+		if create_new:
+			controls = stragglers.get((channel, track), [None, _Controls()])[1]
+			instruments[key] = [[], controls]
+			return instruments[key]
+		stragglers[(channel, track)] = [[], _Controls()]
+		return stragglers[(channel, track)]
+
+	for track_idx, track in enumerate(midi_data.tracks):
+		last_note_on = defaultdict(list)
+		current_instrument = [0] * 16
+		tick = 0
+		for event in track:
+			tick += event.time
+			if event.type == 'program_change':
+				current_instrument[event.channel] = event.program
+			elif event.type == 'note_on' and event.velocity > 0:
+				last_note_on[(event.channel, event.note)].append((tick, event.velocity))
+			elif event.type == 'note_off' or (event.type == 'note_on' and event.velocity == 0):
+				key = (event.channel, event.note)
+				if key in last_note_on:
+					# a note-off closes all notes of its pitch that were not
+					# turned on at the same tick
+					notes_to_close = [n for n in last_note_on[key] if n[0] != tick]
+					notes_to_keep = [n for n in last_note_on[key] if n[0] == tick]
+					for start_tick, velocity in notes_to_close:
+						notes, _ = _get_instrument(current_instrument[event.channel],
+												   event.channel, track_idx, True)
+						notes.append((event.note, velocity, start_tick, tick))
+					if len(notes_to_close) > 0 and len(notes_to_keep) > 0:
+						last_note_on[key] = notes_to_keep
+					else:
+						del last_note_on[key]
+			elif event.type == 'pitchwheel':
+				_, controls = _get_instrument(current_instrument[event.channel],
+											  event.channel, track_idx, False)
+				controls.add(tick, abs(event.pitch) >= 1)
+			elif event.type == 'control_change':
+				_, controls = _get_instrument(current_instrument[event.channel],
+											  event.channel, track_idx, False)
+				controls.add(tick, event.control == 64 and event.value >= 64)
+
+	tracks = []
+	for (program, channel, _), (note_list, controls) in instruments.items():
+		notes = np.zeros(len(note_list), dtype=NOTE_DTYPE)
+		if len(note_list) > 0:
+			pitches, velocities, start_ticks, end_ticks = np.array(note_list, dtype=np.int64).T
+			notes['pitch'], notes['velocity'] = pitches, velocities
+			notes['start'], notes['end'] = tempo_map.to_time(start_ticks), tempo_map.to_time(end_ticks)
+		# pretty_midi's remove_invalid_notes
+		notes = notes[notes['end'] > notes['start']]
+
+		controls_end_time = None
+		if controls.last_tick is not None:
+			controls_end_time = float(tempo_map.to_time(controls.last_tick))
+		tracks.append(NoteTrack(program, channel == 9, notes, controls_end_time,
+								controls.alters_roll))
+	return NoteMidi(tracks)
+
+
+# Compares the tracks read by read_midi with the instruments of pretty_midi
+# for a midi file, returns a list of differences
+def compare_with_pretty_midi(path):
+	import pretty_midi
+	pm = pretty_midi.PrettyMIDI(path)
+	pm.remove_invalid_notes()
+	tracks = read_midi(path).instruments
+
+	if len(tracks) != len(pm.instruments):
+		return ['{} instruments instead of {}'.format(len(tracks), len(pm.instruments))]
+	differences = []
+	for i, (track, instrument) in enumerate(zip(tracks, pm.instruments)):
+		expected = np.array([(n.pitch, n.velocity, n.start, n.end) for n in instrument.notes],
+							dtype=NOTE_DTYPE)
+		if track.program != instrument.program or track.is_drum != instrument.is_drum:
+			differences.append('instrument {}: program or drum flag differs'.format(i))
+		if not np.array_equal(track.notes, expected):
+			differences.append('instrument {}: notes differ'.format(i))
+		if track.get_end_time() != instrument.get_end_time():
+			differences.append('instrument {}: end time {} instead of {}'.format(
+				i, track.get_end_time(), instrument.get_end_time()))
+	return differences
+
+
+if __name__ == '__main__':
+	import os
+	import argparse
+	parser = argparse.ArgumentParser(description='Check that read_midi reads the same notes '
+												 'as pretty_midi for the midi files in a directory.')
+	parser.add_argument('data_dir', type=str)
+	args = parser.parse_args()
+
+	midi_files = [os.path.join(args.data_dir, path) \
+				  for path in os.listdir(args.data_dir) \
+				  if '.mid' in path or '.midi' in path]
+	num_different = 0
+	for path in midi_files:
+		try:
+			differences = compare_with_pretty_midi(path)
+		except Exception as e:
+			differences = ['error: {}'.format(e)]
+		if len(differences) > 0:
+			num_different += 1
+			print('{}: {}'.format(path, '; '.join(differences)))
+	print('{}/{} files differ from pretty_midi'.format(num_different, len(midi_files)))
@@ -0,0 +1,161 @@
+"""
+	NumPy inference for trained models
+
+	export_model writes the layer configs and weights of a trained keras model
+	to a single .npz file. load_model reads it back into a NumpyModel, which
+	runs the forward pass of the LSTM, Dense, Embedding and activation layers
+	with plain NumPy (dropout is a no-op at inference) and returns the same
+	probabilities as model.predict. Sampling with an exported model doesn't
+	need keras or a backend.
+
+	Export the newest (or a given) checkpoint of an experiment with
+		python numpy_model.py --experiment_dir experiments/01 [--from_checkpoint 005]
+"""
+import json
+
+import numpy as np
+
+# the layer config values used by the forward pass
+LAYER_CONFIG_KEYS = ['units', 'activation', 'recurrent_activation', 'use_bias',
+					 'return_sequences', 'go_backwards', 'input_dim', 'output_dim', 'n', 'axis']
+
+
+def export_model(model, path):
+	import keras
+	layers, weights = [], {}
+	for i, layer in enumerate(model.layers):
+		config = layer.get_config()
+		layers.append({
+			'class_name': layer.__class__.__name__,
+			'config': {k: config[k] for k in LAYER_CONFIG_KEYS if k in config}
+		})
+		for j, w in enumerate(layer.get_weights()):
+			weights['{}_{}'.format(i, j)] = w
+
+	input_shape = model.input_shape if isinstance(model.input_shape, list) else [model.input_shape]
+	config = {
+		'layers': layers,
+		'input_shape': [list(shape) for shape in input_shape],
+		# hard_sigmoid changed its slope in keras 3
+		'keras_version': keras.__version__
+	}
+	np.savez(path, config=np.array(json.dumps(config)), **weights)
+
+
+def load_model(path):
+	with np.load(path) as data:
+		config = json.loads(str(data['config']))
+		weights = [[data['{}_{}'.format(i, j)] for j in range(_num_weights(data, i))]
+				   for i in range(len(config['layers']))]
+	return NumpyModel(config, weights)
+
+
+def _num_weights(data, layer_index):
+	prefix = '{}_'.format(layer_index)
+	return len([k for k in data.files if k.startswith(prefix)])
+
+
+class NumpyModel(object):
+	'''Forward pass of an exported model. Has the input_shape and predict() of
+	the keras model, so it can be used by utils.generate.'''
+
+	def __init__(self, config, weights):
+		self.layers = config['layers']
+		self.weights = weights
+		input_shape = [tuple(shape) for shape in config['input_shape']]
+		self.input_shape = input_shape if len(input_shape) > 1 else input_shape[0]
+		self.activations = dict(ACTIVATIONS)
+		if int(config['keras_version'].split('.')[0]) < 3:
+			self.activations['hard_sigmoid'] = lambda x: np.clip(0.2 * x + 0.5, 0., 1.)
+
+	def predict(self, inputs, batch_size=None):
+		inputs = inputs if isinstance(inputs, list) else [inputs]
+		# the embedding models of train.get_embedding_model concatenate the
+		# repeated conditioning input and the embedded notes
+		x, repeated = inputs[0], None
+		for layer, weights in zip(self.layers, self.weights):
+			name, config = layer['class_name'], layer['config']
+			if name == 'InputLayer' or name == 'Dropout':
+				continue
+			elif name == 'Embedding':
+				x = weights[0][x.astype(np.int64)]
+			elif name == 'RepeatVector':
+				repeated = np.repeat(inputs[1][:, np.newaxis, :], config['n'], axis=1)
+			elif name == 'Concatenate':
+				x = np.concatenate([repeated, x], axis=-1)
+			elif name == 'LSTM':
+				x = self._lstm(x, config, weights)
+			elif name == 'Dense':
+				x = np.dot(x, weights[0])
+				if config.get('use_bias', True):
+					x = x + weights[1]
+				x = self.activations[config['activation']](x)
+			elif name == 'Activation':
+				x = self.activations[config['activation']](x)
+			else:
+				raise Exception('Error: the numpy model doesn\'t support {} layers'.format(name))
+		return x
+
+	def _lstm(self, x, config, weights):
+		kernel, recurrent_kernel = weights[0], weights[1]
+		bias = weights[2] if config.get('use_bias', True) else 0.
+		activation = self.activations[config['activation']]
+		recurrent_activation = self.activations[config['recurrent_activation']]
+		units = config['units']
+
+		# the input projections of all steps at once
+		projected = np.dot(x, kernel) + bias
+		steps = range(x.shape[1])
+		if config.get('go_backwards', False):
+			steps = reversed(steps)
+
+		h = np.zeros((x.shape[0], units), dtype=projected.dtype)
+		c = np.zeros_like(h)
+		outputs = []
+		for t in steps:
+			z = projected[:, t] + np.dot(h, recurrent_kernel)
+			i = recurrent_activation(z[:, :units])
+			f = recurrent_activation(z[:, units:2 * units])
+			c = f * c + i * activation(z[:, 2 * units:3 * units])
+			o = recurrent_activation(z[:, 3 * units:])
+			h = o * activation(c)
+			outputs.append(h)
+
+		if config.get('return_sequences', False):
+			return np.stack(outputs, axis=1)
+		return h
+
+
+def _softmax(x):
+	e = np.exp(x - np.max(x, axis=-1, keepdims=True))
+	return e / np.sum(e, axis=-1, keepdims=True)
+
+
+ACTIVATIONS = {
+	'linear': lambda x: x,
+	'tanh': np.tanh,
+	'sigmoid': lambda x: 1. / (1. + np.exp(-x)),
+	'hard_sigmoid': lambda x: np.clip(x / 6. + 0.5, 0., 1.),
+	'relu': lambda x: np.maximum(x, 0.),
+	'softmax': _softmax
+}
+
+
+if __name__ == '__main__':
+	import os
+	import argparse
+	import utils
+	parser = argparse.ArgumentParser(description='Export the checkpoint of an experiment '
+												 'for numpy inference.')
+	parser.add_argument('--experiment_dir', type=str, required=True)
+	parser.add_argument('--from_checkpoint', type=str, default=None,
+						help='Epoch of the checkpoint to export. Defaults to the newest checkpoint.')
+	parser.add_argument('--output', type=str, default=None,
+						help='Defaults to model.npz in --experiment_dir.')
+	args = parser.parse_args()
+
+	model, _ = utils.load_inference_model(args.experiment_dir, args.from_checkpoint)
+
+	output = args.output or os.path.join(args.experiment_dir, 'model.npz')
+	export_model(model, output)
+	print('Exported model to {}'.format(output))
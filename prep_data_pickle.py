@@ -1,61 +1,164 @@
 """
 	Prepare the midi windows to increase load time during training
 	If the dataset is prepared, training will not have to read from disk and be much faster
+	The tracks are written to a memory mapped dataset directory (see dataset.py)
+
+	Files are parsed by a pool of worker processes and their tracks are streamed
+	into the dataset, which is committed every --checkpoint_every files together
+	with a manifest of the processed files and their content hashes.
+
+	Running again with the same --dataset_dir updates the dataset incrementally:
+	it resumes an interrupted run, appends the tracks of new files, replaces the
+	tracks of changed files and drops the tracks of files removed from --data_dir.
+	Existing events are never rewritten.
 """
 import os
-import pickle
+import argparse
+import hashlib
 import random
 
 from datetime import datetime
-from pretty_midi import pretty_midi
-
-import utils
-
-# Params
-data_dir = "data"
-target = "pickle-data"
-window_size = 20
-
-midi_files = [os.path.join(data_dir, path) \
-			  for path in os.listdir(data_dir) \
-			  if '.mid' in path or '.midi' in path]
-random.shuffle(midi_files)
-
-total_events = 0
-all_tracks = []
-for i, path in enumerate(midi_files):
-	print(f"Progress: {i}/{len(midi_files)}. total tracks: {len(all_tracks)}. total events: {total_events}")
-	# Load midi
-	midi = None
+from functools import partial
+from multiprocessing import Pool
+
+import data_utils
+from dataset import DatasetWriter
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--data_dir', type=str, default='data',
+						help='data directory containing .mid files to prepare')
+	parser.add_argument('--target', type=str, default='pickle-data',
+						help='directory to create the dataset directory in')
+	parser.add_argument('--dataset_dir', type=str, default=None,
+						help='dataset directory to write to. If it already exists, it is ' \
+							 'updated with the new, changed and removed files of --data_dir. ' \
+							 'If omitted, a new dataset_<timestamp> directory is created ' \
+							 'in --target. To resume an interrupted run, pass the directory ' \
+							 'it printed at startup.')
+	parser.add_argument('--window_size', type=int, default=20,
+						help='Tracks with fewer notes than this are skipped.')
+	parser.add_argument('--n_jobs', '-j', type=int, default=1,
+						help='Number of CPUs to use when parsing midi files.')
+	parser.add_argument('--checkpoint_every', type=int, default=100,
+						help='Commit the dataset and the manifest after this many files.')
+	return parser.parse_args()
+
+
+# parse a midi file in a worker process, returns its path, tracks and any error
+def prepare_file(path, window_size):
 	try:
-		midi = pretty_midi.PrettyMIDI(path)
-		midi.remove_invalid_notes()
+		tracks = data_utils._load_midi_tracks(path, window_size)
 	except Exception as e:
-		print(f"Skipping {path}, error: {e}")
-		continue
-
-	# Get tracks
-	tracks = []
-	melody_instruments = utils.filter_monophonic(midi.instruments, 1.0)
-	for instrument in melody_instruments:
-		if len(instrument.notes) > window_size:
-			roll = utils.get_instrument_roll(instrument)
-			if len(roll) > 0:
-				instrument_group = utils.get_family_id_by_instrument_normalized(instrument.program)
-				tracks.append({
-					'roll': roll, 'instrument': instrument_group
-				})
-				total_events += len(roll)
-
-	all_tracks += tracks
-
-	del midi
-
-print(f"Found a total of {len(all_tracks)} usable instrument tracks with a total of {total_events} events.")
-
-# Dump
-time = datetime.now().strftime("%Y%m%d_%H%M%S")
-with open(f"{target}/dataset_{time}.pkl", 'wb') as f:
-	pickle.dump(all_tracks, f)
-
-t=2
\ No newline at end of file
+		return path, [], str(e)
+	# store the compact pitch index per step instead of the one-hot roll,
+	# the generators expand these one batch at a time during training
+	return path, [(t['indices'], t['instrument']) for t in tracks if len(t['indices']) > 0], None
+
+
+def file_hash(path):
+	sha1 = hashlib.sha1()
+	with open(path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			sha1.update(block)
+	return sha1.hexdigest()
+
+
+def file_stat(path):
+	stat = os.stat(path)
+	return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+# Returns the files of midi_files that are new or whose content changed since
+# they were added to the dataset. Changed and removed files are dropped from the
+# dataset, only files with a changed size or mtime are hashed.
+def sync_manifest(writer, midi_files, map_fn=map):
+	current = set(midi_files)
+	for path in list(writer.files):
+		if path not in current:
+			print(f"Removing tracks of {path}")
+			writer.remove_source(path)
+			del writer.files[path]
+
+	stats = {path: file_stat(path) for path in midi_files}
+	to_hash = [path for path in midi_files if path not in writer.files or
+			   any(writer.files[path].get(k) != v for k, v in stats[path].items())]
+	hashes = dict(zip(to_hash, map_fn(file_hash, to_hash)))
+
+	pending = []
+	for path in to_hash:
+		entry = writer.files.get(path)
+		if entry is not None:
+			if entry.get('sha1') == hashes[path]:
+				entry.update(stats[path])  # touched, but the content didn't change
+				continue
+			if 'sha1' not in entry:
+				print(f"Replacing tracks of {path}, the dataset has no content hash of it")
+			else:
+				print(f"Replacing tracks of changed file {path}")
+			writer.remove_source(path)
+			del writer.files[path]
+		pending.append(path)
+
+	return pending, {path: dict(stats[path], sha1=hashes[path]) for path in pending}
+
+
+def main():
+	args = parse_args()
+
+	dataset_dir = args.dataset_dir
+	if dataset_dir is None:
+		time = datetime.now().strftime("%Y%m%d_%H%M%S")
+		dataset_dir = os.path.join(args.target, f"dataset_{time}")
+	writer = DatasetWriter(dataset_dir)
+	# printed up front, so an interrupted run can be resumed with --dataset_dir
+	print(f"Writing dataset to {dataset_dir} (pass --dataset_dir {dataset_dir} to resume)")
+
+	midi_files = [os.path.join(args.data_dir, path) \
+				  for path in os.listdir(args.data_dir) \
+				  if '.mid' in path or '.midi' in path]
+	random.shuffle(midi_files)
+
+	if args.n_jobs > 1:
+		pool = Pool(args.n_jobs)
+
+	pending, file_info = sync_manifest(writer, midi_files,
+									   pool.map if args.n_jobs > 1 else map)
+	if len(pending) < len(midi_files):
+		print(f"Updating {dataset_dir}: {len(midi_files) - len(pending)} files are up to date")
+
+	prepare = partial(prepare_file, window_size=args.window_size)
+	if args.n_jobs > 1:
+		results = pool.imap_unordered(prepare, pending, chunksize=4)
+	else:
+		results = map(prepare, pending)
+
+	total_events = 0
+	total_tracks = 0
+	for i, (path, tracks, error) in enumerate(results):
+		if error is not None:
+			print(f"Skipping {path}, error: {error}")
+			writer.files[path] = dict(file_info[path], tracks=0, error=error)
+		else:
+			for indices, instrument_group in tracks:
+				writer.add_track(indices, instrument_group, path)
+				total_events += len(indices)
+			total_tracks += len(tracks)
+			writer.files[path] = dict(file_info[path], tracks=len(tracks))
+
+		if (i + 1) % args.checkpoint_every == 0:
+			writer.commit()
+			print(f"Progress: {i + 1}/{len(pending)}. total tracks: {total_tracks}. total events: {total_events}")
+
+	writer.close()
+	if args.n_jobs > 1:
+		pool.close()
+
+	print(f"Found a total of {total_tracks} usable instrument tracks with a total of {total_events} events.")
+	print(f"Dataset written to {dataset_dir}")
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,157 @@
+"""
+	On-disk cache of the prepared tracks of parsed midi files
+
+	Training without a prepared dataset parses every midi file again each time
+	the data generator loops over it. The cache stores the pitch index tracks
+	of a file (see data_utils._load_midi_tracks) under a key of its path, mtime, size
+	and the window settings, and serves them from a memory mapped array on later
+	passes. The least recently used entries are evicted when the cache grows
+	beyond its size limit.
+
+	The total size of the cache is kept in a size file next to the entries, which
+	every write updates under a file lock. The cache is used from the worker
+	processes of the data generators, so the count has to be shared between
+	processes. The directory is only scanned when the size file is missing and
+	when the cache is full. Eviction then frees some headroom below the limit, so
+	that the following writes don't each trigger another scan.
+"""
+import os
+import json
+import fcntl
+import hashlib
+
+import numpy as np
+
+# bump when the way tracks are extracted from midi files changes
+CACHE_VERSION = 1
+
+# eviction shrinks the cache to this fraction of its size limit
+EVICT_TO = 0.9
+
+# total size of the entries in the cache, and the lock that guards it and eviction
+SIZE_FILE = 'size'
+LOCK_FILE = 'size.lock'
+
+
+class RollCache(object):
+
+	def __init__(self, cache_dir, max_size=2048 * 1024 * 1024):
+		self.cache_dir = cache_dir
+		self.max_size = max_size
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir)
+
+	# the tracks of the midi file at path, loaded with load_fn(path, window_size)
+	# if they aren't cached yet
+	def load_tracks(self, path, window_size, load_fn):
+		key = self._key(path, window_size)
+		tracks = self._read(key)
+		if tracks is None:
+			tracks = load_fn(path, window_size)
+			self._add_size(self._write(key, tracks))
+		return tracks
+
+	def _key(self, path, window_size):
+		stat = os.stat(path)
+		key = '{}|{}|{}|{}|{}'.format(os.path.abspath(path), stat.st_mtime_ns, stat.st_size,
+									  window_size, CACHE_VERSION)
+		return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+	def _paths(self, key):
+		return os.path.join(self.cache_dir, key + '.json'), \
+			   os.path.join(self.cache_dir, key + '.npy')
+
+	def _read(self, key):
+		meta_path, events_path = self._paths(key)
+		try:
+			with open(meta_path) as f:
+				meta = json.load(f)
+			if sum(meta['lengths']) > 0:
+				events = np.load(events_path, mmap_mode='r')
+			else:  # empty arrays can't be memory mapped
+				events = np.zeros(0, dtype=np.uint8)
+		except (OSError, ValueError):
+			return None
+
+		# mark the entry as recently used
+		os.utime(meta_path)
+
+		tracks, offset = [], 0
+		for length, instrument in zip(meta['lengths'], meta['instruments']):
+			tracks.append({'indices': events[offset:offset + length], 'instrument': instrument})
+			offset += length
+		return tracks
+
+	# returns the size of the written entry
+	def _write(self, key, tracks):
+		meta_path, events_path = self._paths(key)
+		meta = {
+			'lengths': [len(t['indices']) for t in tracks],
+			'instruments': [t['instrument'] for t in tracks]
+		}
+		# the events are written first, the meta file commits the entry
+		size = 0
+		if sum(meta['lengths']) > 0:
+			events = np.concatenate([t['indices'] for t in tracks]).astype(np.uint8)
+			with open(events_path + '.tmp', 'wb') as f:
+				np.save(f, events)
+				size += f.tell()
+			os.replace(events_path + '.tmp', events_path)
+		with open(meta_path + '.tmp', 'w') as f:
+			json.dump(meta, f)
+			size += f.tell()
+		os.replace(meta_path + '.tmp', meta_path)
+		return size
+
+	# (last use, size, meta path, events path) of every entry in the cache
+	def _entries(self):
+		entries = []
+		for entry in os.scandir(self.cache_dir):
+			if not entry.name.endswith('.json'):
+				continue
+			meta_path, events_path = self._paths(entry.name[:-len('.json')])
+			try:
+				stat = entry.stat()
+				size = stat.st_size
+				if os.path.exists(events_path):
+					size += os.path.getsize(events_path)
+			except OSError:
+				continue  # evicted by another process
+			entries.append((stat.st_mtime, size, meta_path, events_path))
+		return entries
+
+	# adds the size of a new entry to the size file, and evicts entries once the
+	# cache is larger than max_size
+	def _add_size(self, size):
+		size_path = os.path.join(self.cache_dir, SIZE_FILE)
+		with open(os.path.join(self.cache_dir, LOCK_FILE), 'w') as lock:
+			fcntl.flock(lock, fcntl.LOCK_EX)
+			try:
+				with open(size_path) as f:
+					total_size = int(f.read()) + size
+			except (OSError, ValueError):
+				# a new cache, or one written before the size file existed
+				total_size = sum(size for _, size, _, _ in self._entries())
+			if total_size > self.max_size:
+				total_size = self._evict()
+			with open(size_path + '.tmp', 'w') as f:
+				f.write(str(total_size))
+			os.replace(size_path + '.tmp', size_path)
+
+	# remove the least recently used entries until the cache fits in EVICT_TO
+	# of max_size, returns the size of the remaining entries. An entry that is
+	# written during the scan can later be added to the size file again, so the
+	# size file is an upper bound, which the next eviction corrects.
+	def _evict(self):
+		entries = self._entries()
+		total_size = sum(size for _, size, _, _ in entries)
+		for _, size, meta_path, events_path in sorted(entries):
+			if total_size <= self.max_size * EVICT_TO:
+				break
+			for path in (meta_path, events_path):
+				try:
+					os.remove(path)
+				except OSError:
+					pass
+			total_size -= size
+		return total_size
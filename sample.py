@@ -6,8 +6,11 @@ import random
 import pretty_midi
 from datetime import datetime
 
-import train
 import utils
+import data_utils
+import numpy_model
+import checkpoint_index
+import seed_bank
 import numpy as np
 
 def parse_args():
@@ -36,9 +39,18 @@ def parse_args():
 							 'for seeding.')
 	parser.add_argument('--from_checkpoint', type=str,
 						help='Load model from specific checkpoint within experiment_dir')
+	parser.add_argument('--checkpoint_metric', type=str,
+						help='Load the best checkpoint by this metric (e.g. val_acc) ' \
+							 'instead of the newest one.')
 	parser.add_argument('--data_dir', type=str, default='data',
 						help='data directory containing .mid files to use for' \
 							 'seeding/priming. Required if --prime_file is not specified')
+	parser.add_argument('--seed_bank', type=str,
+						help='seed bank file (see seed_bank.py) to draw random seeds from ' \
+							 'instead of parsing the files of --data_dir.')
+	parser.add_argument('--seed_family', type=str,
+						help='Only draw seeds of this instrument family (e.g. Strings) or ' \
+							 'of the family of this instrument from --seed_bank.')
 	parser.add_argument('--use_instrument', action='store_true',
 						help='Use instrument type in input.')
 	parser.add_argument('--ignore_empty', action='store_true',
@@ -47,25 +59,57 @@ def parse_args():
 						help='Encode source track sections.')
 	parser.add_argument('--multi_instruments', action='store_true',
 						help='Use multiple instruments to generate a single sample from the prime file.')
+	parser.add_argument('--stateful', action='store_true',
+						help='Prime a stateful copy of the model on the seed and feed it one ' \
+							 'note per step, instead of feeding the whole window every step. ' \
+							 'The model then remembers more than window_size steps.')
+	parser.add_argument('--temperature', type=float, default=1.0,
+						help='Sampling temperature. Lower values make the generated notes ' \
+							 'more predictable, higher values more random.')
+	parser.add_argument('--top_k', type=int, default=None,
+						help='Only sample from the k most likely notes (and rests).')
+	parser.add_argument('--numpy_model', type=str,
+						help='Run the forward pass with numpy, using a model exported by ' \
+							 'numpy_model.py instead of the checkpoints of --experiment_dir. ' \
+							 '--experiment_dir is then not used and --save_dir defaults to ' \
+							 'generated/ next to the exported model.')
 	return parser.parse_args()
 
 
 def get_experiment_dir(experiment_dir):
 	if experiment_dir == 'experiments/default':
-		dirs_ = [os.path.join('experiments', d) for d in os.listdir('experiments') \
-				 if os.path.isdir(os.path.join('experiments', d))]
-		experiment_dir = max(dirs_, key=os.path.getmtime)
+		experiment_dir = checkpoint_index.latest_experiment('experiments')
+		if experiment_dir is None:
+			utils.log('Error: found no experiments in experiments/. Exiting.', True)
+			exit(1)
 
 	if not os.path.exists(os.path.join(experiment_dir, 'model.json')):
 		utils.log('Error: {} does not exist. ' \
-				  'Are you sure that {} is a valid experiment?' \
-				  'Exiting.'.format(os.path.join(args.experiment_dir), 'model.json',
+				  'Are you sure that {} is a valid experiment? ' \
+				  'Exiting.'.format(os.path.join(experiment_dir, 'model.json'),
 									experiment_dir), True)
 		exit(1)
 
 	return experiment_dir
 
 
+# num_seeds random encoded windows of the monophonic tracks of midi files
+def get_seed_windows(midi_files, window_size, num_seeds, use_instrument=False,
+					 ignore_empty=False, encode_section=False):
+	tracks = data_utils.load_midi_tracks(midi_files, window_size)
+	window_track, window_pos = data_utils.build_window_index(tracks, window_size, ignore_empty)
+	if len(window_pos) == 0:
+		utils.log('Error: found no seed windows in {} files. Exiting.'.format(len(midi_files)),
+				  True)
+		exit(1)
+	choice = np.random.randint(0, len(window_pos), num_seeds)
+	window_track, window_pos = window_track[choice], window_pos[choice]
+	X, _ = data_utils.gather_track_windows(tracks, window_track, window_pos, window_size)
+	instruments, sections = data_utils.get_window_conditioning(
+		*data_utils.get_track_window_counts(tracks, window_size), window_track, window_pos)
+	return data_utils._encode_input(X, instruments, sections, use_instrument, encode_section)
+
+
 def main():
 	args = parse_args()
 	args.verbose = True
@@ -75,48 +119,56 @@ def main():
 		utils.log('Error: prime file {} does not exist. Exiting.'.format(args.prime_file),
 				  True)
 		exit(1)
-	else:
+	elif args.seed_bank and not os.path.exists(args.seed_bank):
+		utils.log('Error: seed bank {} does not exist. Exiting.'.format(args.seed_bank),
+				  True)
+		exit(1)
+	elif not args.prime_file and not args.seed_bank:
 		if not os.path.isdir(args.data_dir):
-			utils.log('Error: data dir {} does not exist. Exiting.'.format(args.prime_file),
+			utils.log('Error: data dir {} does not exist. Exiting.'.format(args.data_dir),
 					  True)
 			exit(1)
 
-	midi_files = [args.prime_file] if args.prime_file else \
-		[os.path.join(args.data_dir, f) for f in os.listdir(args.data_dir) \
-		 if '.mid' in f or '.midi' in f]
+	if args.prime_file:
+		midi_files = [args.prime_file]
+	elif args.seed_bank:
+		midi_files = []
+	else:
+		midi_files = [os.path.join(args.data_dir, f) for f in os.listdir(args.data_dir) \
+					  if '.mid' in f or '.midi' in f]
 
-	experiment_dir = get_experiment_dir(args.experiment_dir)
-	utils.log('Using {} as --experiment_dir'.format(experiment_dir), args.verbose)
+	if args.numpy_model:
+		# an exported model doesn't need its experiment directory
+		if not os.path.exists(args.numpy_model):
+			utils.log('Error: numpy model {} does not exist. Exiting.'.format(args.numpy_model),
+					  True)
+			exit(1)
+		if not args.save_dir:
+			args.save_dir = os.path.join(os.path.dirname(os.path.abspath(args.numpy_model)),
+										 'generated')
+	else:
+		experiment_dir = get_experiment_dir(args.experiment_dir)
+		utils.log('Using {} as --experiment_dir'.format(experiment_dir), args.verbose)
 
-	if not args.save_dir:
-		args.save_dir = os.path.join(experiment_dir, 'generated')
+		if not args.save_dir:
+			args.save_dir = os.path.join(experiment_dir, 'generated')
 
 	if not os.path.isdir(args.save_dir):
 		os.makedirs(args.save_dir)
 		utils.log('Created directory {}'.format(args.save_dir), args.verbose)
 
-	if not args.from_checkpoint:
-		model, epoch = train.get_model(args, experiment_dir=experiment_dir)
-		utils.log('Model loaded from {}'.format(os.path.join(experiment_dir, 'model.json')),
-				  args.verbose)
+	if args.numpy_model:
+		if args.stateful:
+			utils.log('Error: --stateful is not supported by --numpy_model. Exiting.', True)
+			exit(1)
+		model = numpy_model.load_model(args.numpy_model)
+		utils.log('Model loaded from {}'.format(args.numpy_model), args.verbose)
 	else:
-		# Load from checkpoint
-		with open(os.path.join(experiment_dir, 'model.json'), 'r') as f:
-			model = utils.model_from_json(f.read())
-		epoch = int(args.from_checkpoint)
-		newest_checkpoint = os.path.join(experiment_dir, f"checkpoints/checkpoint-epoch_{args.from_checkpoint}.hdf5")
-		utils.load_checkpoint(model, newest_checkpoint)
-		utils.log('Model loaded from checkpoint {}'.format(newest_checkpoint), args.verbose)
-
-	window_size = model.layers[0].get_input_shape_at(0)[1]
-	seed_generator = utils.get_data_generator(midi_files,
-											  window_size=window_size,
-											  batch_size=32,
-											  num_threads=1,
-											  use_instrument=args.use_instrument,
-											  ignore_empty=args.ignore_empty,
-											  encode_section=args.encode_section,
-											  max_files_in_ram=10)
+		model, epoch = utils.load_inference_model(experiment_dir, args.from_checkpoint,
+												  args.checkpoint_metric)
+		utils.log('Model loaded from {} (epoch {})'.format(experiment_dir, epoch), args.verbose)
+
+	window_size = utils.get_model_window_size(model)
 
 	# validate midi instrument name
 	try:
@@ -147,61 +199,36 @@ def main():
 
 		generated_midi = pretty_midi.PrettyMIDI(initial_tempo=80)
 
-		source_midi = utils.parse_midi(args.prime_file)
+		source_midi = data_utils.parse_midi(args.prime_file)
 
 		melody_instruments = source_midi.instruments
-		# melody_instruments = utils.filter_monophonic(source_midi.instruments, 1.0)
+		# melody_instruments = data_utils.filter_monophonic(source_midi.instruments, 1.0)
 
+		# Get a source track seed of every instrument
+		seeds, instrument_groups, programs = [], [], []
 		for instrument in melody_instruments:
-			instrument_group = utils.get_family_id_by_instrument_normalized(instrument.program)
-
-			# Get source track seed
-			X, y = [], []
-			windows = utils._encode_sliding_windows(instrument, window_size)
-			for w in windows:
-				if np.min(w[0][:, 0]) == 1:
-					# Window only contains pauses.. ignore!
-					continue
-				X.append(w[0])
+			X, y = data_utils._encode_sliding_windows(instrument, window_size)
+			# Ignore windows that only contain pauses..
+			X = X[np.max(X, axis=1) != 0]
 			if len(X) <= 5:
 				continue
-			seed = X[random.randint(0, len(X) - 1)]
-
-			# Generate track for this instrument
-			generated = []
-			buf = np.copy(seed).tolist()
-			while len(generated) < args.file_length:
-				buf_expanded = [x for x in buf]
-
-				# Add instrument class to input
-				if args.use_instrument:
-					buf_expanded = [[instrument_group] + x for x in buf_expanded]
-
-				# Add section encoding to input
-				if args.encode_section:
-					sections = [0] * 4
-					active_section = int((len(generated) / args.file_length) * 4)
-					sections[active_section] = 1
-					buf_expanded = [sections + x for x in buf_expanded]
-
-				# Get prediction
-				arr = np.expand_dims(np.asarray(buf_expanded), 0)
-				pred = model.predict(arr)
-
-				# prob distribution sampling
-				index = np.random.choice(range(0, seed.shape[1]), p=pred[0])
-				pred = np.zeros(seed.shape[1])
+			seeds.append(X[random.randint(0, len(X) - 1)])
+			instrument_groups.append(data_utils.get_family_id_by_instrument_normalized(instrument.program))
+			programs.append(instrument.program)
 
-				pred[index] = 1
-				generated.append(pred)
-				buf.pop(0)
-				buf.append(pred.tolist())
+		if len(seeds) > 0:
+			# Generate the tracks of all instruments together
+			generated = utils.generate_indices(model, np.array(seeds), args.file_length,
+											   np.array(instrument_groups), args.use_instrument,
+											   args.encode_section, args.stateful,
+											   args.temperature, args.top_k)
 
-			# Create instrument
-			instrument = utils._network_output_to_instrument(generated, instrument.program)
+			for indices, program in zip(generated, programs):
+				# Create instrument
+				instrument = data_utils._network_output_to_instrument(data_utils.indices_to_roll(indices), program)
 
-			# Add to target midi
-			generated_midi.instruments.append(instrument)
+				# Add to target midi
+				generated_midi.instruments.append(instrument)
 
 		if len(generated_midi.instruments) == 0:
 			raise Exception(f"Found no monophonic instruments in {args.prime_file}")
@@ -214,10 +241,19 @@ def main():
 
 	else:
 		# generate 10 tracks using random seeds
-		utils.log('Loading seed files...', args.verbose)
-		X, y = next(seed_generator)
+		if args.seed_bank and not args.prime_file:
+			utils.log('Drawing seeds from {}...'.format(args.seed_bank), args.verbose)
+			windows, instruments = seed_bank.load(args.seed_bank).draw(window_size, args.num_files,
+																	   args.seed_family)
+			X = data_utils._encode_input(windows, instruments, np.zeros(len(windows), dtype=int),
+										 args.use_instrument, args.encode_section)
+		else:
+			utils.log('Loading seed files...', args.verbose)
+			X = get_seed_windows(midi_files[:10], window_size, 32, args.use_instrument,
+								 args.ignore_empty, args.encode_section)
 		generated = utils.generate(model, X, window_size,
-								   args.file_length, args.num_files, args.midi_instrument, use_instrument=args.use_instrument, encode_section=args.encode_section)
+								   args.file_length, args.num_files, args.midi_instrument, use_instrument=args.use_instrument, encode_section=args.encode_section,
+								   stateful=args.stateful, temperature=args.temperature, top_k=args.top_k)
 		for i, midi in enumerate(generated):
 			file = os.path.join(args.save_dir, f"{i+1}_instrument{midi.instruments[0].program}.mid")
 			midi.write(file.format(i + 1))
@@ -0,0 +1,58 @@
+"""
+	Batched sampling of generated notes
+
+	sample() draws one class index per row of a batch of predicted
+	distributions at once, with an inverse CDF lookup (cumsum + searchsorted)
+	instead of a np.random.choice call per row. The distributions can be
+	sharpened or flattened with a temperature and restricted to their top_k
+	classes. WindowBuffer holds the input windows and the generated indices of a
+	batch of sequences in preallocated arrays.
+"""
+import numpy as np
+
+
+def sample(probs, temperature=1.0, top_k=None):
+	probs = np.asarray(probs, dtype=np.float64)
+	if temperature != 1.0:
+		logits = np.log(np.maximum(probs, 1e-12)) / temperature
+		probs = np.exp(logits - np.max(logits, axis=1, keepdims=True))
+	if top_k is not None and top_k < probs.shape[1]:
+		# zero all but the k most likely classes of every row
+		kth = np.partition(probs, probs.shape[1] - top_k, axis=1)[:, probs.shape[1] - top_k]
+		probs = np.where(probs >= kth[:, np.newaxis], probs, 0.)
+
+	# the rows of the normalized cdf are laid out one after another on [0, num_rows),
+	# so a single searchsorted finds the draws of all rows
+	num_rows, num_classes = probs.shape
+	cdf = np.cumsum(probs, axis=1)
+	cdf /= cdf[:, -1:]
+	rows = np.arange(num_rows)
+	cdf += rows[:, np.newaxis]
+	draws = np.random.random(num_rows) + rows
+	indices = np.searchsorted(cdf.ravel(), draws, side='right') - rows * num_classes
+	return np.minimum(indices, num_classes - 1)
+
+
+class WindowBuffer(object):
+	'''The last window_size pitch indices of a batch of sequences, seeded with
+	(num_seqs, window_size) indices, and all indices appended so far. The window
+	is a ring buffer stored twice in a row, so window() is always a view of
+	window_size contiguous steps and append() writes a single column.'''
+
+	def __init__(self, seeds, length):
+		num_seqs, self.window_size = seeds.shape
+		self._ring = np.tile(np.asarray(seeds, dtype=np.int32), 2)
+		self._start = 0
+		self.generated = np.zeros((num_seqs, length), dtype=np.uint8)
+		self.length = 0
+
+	def window(self):
+		return self._ring[:, self._start:self._start + self.window_size]
+
+	def append(self, indices):
+		# the oldest step is replaced by the new one in both copies of the ring
+		self._ring[:, self._start] = indices
+		self._ring[:, self._start + self.window_size] = indices
+		self._start = (self._start + 1) % self.window_size
+		self.generated[:, self.length] = indices
+		self.length += 1
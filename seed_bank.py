@@ -0,0 +1,153 @@
+"""
+	Seed bank of pre-extracted seed windows
+
+	Sampling without a prime file seeds the model with random windows of the
+	training data. Instead of parsing midi files for them on every run, a seed
+	bank stores a random selection of windows of a prepared dataset (a dataset
+	directory or a legacy pickle, see dataset.py) in a single .npz file:
+		windows     - (num_seeds, window_size) pitch indices, grouped by family
+		instruments - the normalized instrument family of every window
+		sources     - the id of the source file of every window
+		families    - offsets of the windows of every instrument family
+		meta        - json with the window size and the source file paths
+
+	Loading a bank reads a few small arrays and drawing a seed, optionally of a
+	single instrument family, picks a random row of a contiguous slice.
+
+	Build a bank from a prepared dataset with
+		python seed_bank.py pickle-data/dataset_01 seeds.npz [--window_size 20]
+	and use it with sample.py --seed_bank seeds.npz or serve.py --seed_bank seeds.npz
+"""
+import json
+
+import numpy as np
+
+import data_utils
+import dataset
+
+
+def _get_families():
+	_, families, _ = data_utils._get_instrument_families()
+	return families
+
+
+def get_family_id(family):
+	'''The id of an instrument family by name (e.g. "Strings"), or of the family
+	of a General MIDI instrument name or program'''
+	import pretty_midi
+	families = _get_families()
+	names = [f.lower() for f in families]
+	if str(family).lower() in names:
+		return names.index(str(family).lower())
+	try:
+		program = int(family)
+	except ValueError:
+		try:
+			program = pretty_midi.instrument_name_to_program(family)
+		except ValueError:
+			raise ValueError('{} is not an instrument family ({}) or General MIDI instrument'
+							 .format(family, ', '.join(families)))
+	instruments, _, _ = data_utils._get_instrument_families()
+	return instruments[program]
+
+
+def build_seed_bank(tracks, path, window_size=20, num_seeds=10000, ignore_empty=True,
+					default_source=''):
+	'''Writes num_seeds random windows (or all of them, if there are fewer) of
+	prepared tracks to a seed bank file'''
+	window_track, window_pos = data_utils.build_window_index(tracks, window_size, ignore_empty)
+	if len(window_pos) > num_seeds:
+		choice = np.random.choice(len(window_pos), num_seeds, replace=False)
+		window_track, window_pos = window_track[choice], window_pos[choice]
+	track_instruments, _ = data_utils.get_track_window_counts(tracks, window_size)
+	instruments = track_instruments[window_track]
+	windows, _ = data_utils.gather_track_windows(tracks, window_track, window_pos, window_size)
+
+	# group the windows by instrument family
+	num_families = len(_get_families())
+	families = np.rint(instruments * num_families).astype(np.int64)
+	order = np.argsort(families, kind='mergesort')
+	windows, instruments, window_track = windows[order], instruments[order], window_track[order]
+	offsets = np.concatenate([[0], np.cumsum(np.bincount(families, minlength=num_families))])
+
+	# source file ids, looked up once per track
+	unique_tracks, track_ids = np.unique(window_track, return_inverse=True)
+	track_sources = [tracks[int(t)].get('source', default_source) for t in unique_tracks]
+	sources = sorted(set(track_sources))
+	source_index = {s: i for i, s in enumerate(sources)}
+	source_ids = np.array([source_index[s] for s in track_sources], dtype=np.int32)
+
+	np.savez(path,
+			 windows=windows,
+			 instruments=instruments.astype(np.float32),
+			 sources=source_ids[track_ids],
+			 families=offsets.astype(np.int64),
+			 meta=np.array(json.dumps({'window_size': window_size, 'sources': sources})))
+	return len(windows)
+
+
+def load(path):
+	with np.load(path) as data:
+		meta = json.loads(str(data['meta']))
+		return SeedBank(data['windows'], data['instruments'], data['sources'],
+						data['families'], meta['sources'])
+
+
+class SeedBank(object):
+	'''Seed windows with their instrument family and source file'''
+
+	def __init__(self, windows, instruments, sources, families, source_paths):
+		self.windows = windows
+		self.instruments = instruments
+		self.sources = sources
+		self.families = families
+		self.source_paths = source_paths
+		self.window_size = windows.shape[1]
+
+	def __len__(self):
+		return len(self.windows)
+
+	# the range of rows of a family (or all rows)
+	def _rows(self, family=None):
+		if family is None:
+			return 0, len(self.windows)
+		family_id = get_family_id(family)
+		return int(self.families[family_id]), int(self.families[family_id + 1])
+
+	def draw(self, window_size, count, family=None):
+		'''Draws count random seeds, optionally of an instrument family. Returns
+		the last window_size steps of the seed windows and their normalized
+		instrument families.'''
+		if window_size > self.window_size:
+			raise ValueError('the seed bank has windows of {} steps, the model needs {}'
+							 .format(self.window_size, window_size))
+		start, end = self._rows(family)
+		if end <= start:
+			raise ValueError('the seed bank has no seeds of family {}'.format(family))
+		rows = np.random.randint(start, end, count)
+		return self.windows[rows, self.window_size - window_size:], self.instruments[rows]
+
+	def source(self, row):
+		return self.source_paths[self.sources[row]]
+
+
+if __name__ == '__main__':
+	import argparse
+	parser = argparse.ArgumentParser(description='Build a seed bank for sample.py and serve.py '
+												 'from a prepared dataset directory or pickle.',
+									 formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('dataset', type=str)
+	parser.add_argument('output', type=str)
+	parser.add_argument('--window_size', type=int, default=20,
+						help='Length of the seed windows, at least the window size of the models ' \
+							 'that use them.')
+	parser.add_argument('--num_seeds', type=int, default=10000,
+						help='Number of random windows to keep.')
+	parser.add_argument('--keep_empty', action='store_true',
+						help='Also keep windows that only contain rests.')
+	args = parser.parse_args()
+
+	tracks = dataset.load_tracks(args.dataset)
+	num_seeds = build_seed_bank(tracks, args.output, args.window_size, args.num_seeds,
+								not args.keep_empty, args.dataset)
+	print('Wrote {} seeds to {}'.format(num_seeds, args.output))
@@ -0,0 +1,58 @@
+"""
+	keras Sequence datasets. Every batch index maps to a fixed batch of the
+	window index, so fit_generator can prepare batches in several worker
+	threads or processes (--workers and --use_multiprocessing in train.py)
+"""
+import numpy as np
+from keras.utils import Sequence
+
+import data_utils
+
+
+class PreparedSequence(Sequence):
+	'''Batches of windows from prepared tracks, a list of track dicts or a
+	dataset.TrackDataset. With shuffle, the windows are drawn in a new random
+	order every epoch.'''
+
+	def __init__(self, tracks, window_size=20, batch_size=32, use_instrument=False,
+				 ignore_empty=False, encode_section=False, sparse=False, shuffle=True):
+		self.tracks = tracks
+		self.window_size = window_size
+		self.batch_size = batch_size
+		self.use_instrument = use_instrument
+		self.encode_section = encode_section
+		self.sparse = sparse
+		self.shuffle = shuffle
+		self.window_track, self.window_pos = \
+			data_utils.build_window_index(tracks, window_size, ignore_empty)
+		self.track_instruments, self.track_num_windows = \
+			data_utils.get_track_window_counts(tracks, window_size)
+		self.order = np.arange(len(self.window_pos))
+		self.on_epoch_end()
+
+	def __len__(self):
+		return len(self.window_pos) // self.batch_size
+
+	def __getitem__(self, idx):
+		batch = self.order[idx * self.batch_size:(idx + 1) * self.batch_size]
+		X, y = data_utils.gather_track_windows(self.tracks, self.window_track[batch],
+										  self.window_pos[batch], self.window_size)
+		instruments, sections = data_utils.get_window_conditioning(
+			self.track_instruments, self.track_num_windows,
+			self.window_track[batch], self.window_pos[batch])
+		return data_utils._expand_windows(X, y, instruments, sections,
+									 self.use_instrument, self.encode_section, self.sparse)
+
+	def on_epoch_end(self):
+		if self.shuffle:
+			np.random.shuffle(self.order)
+
+
+class MidiSequence(PreparedSequence):
+	'''Batches of windows from the monophonic tracks of midi files. The files are
+	parsed once up front, only their compact pitch index tracks are kept in RAM.'''
+
+	def __init__(self, midi_paths, window_size=20, batch_size=32, num_threads=8, cache=None,
+				 **kwargs):
+		tracks = data_utils.load_midi_tracks(midi_paths, window_size, num_threads, cache)
+		super(MidiSequence, self).__init__(tracks, window_size, batch_size, **kwargs)
@@ -0,0 +1,375 @@
+#!/usr/bin/env python
+"""
+	Generation daemon
+
+	Keeps the models of one or more experiments loaded and generates melodies on
+	request over HTTP, on a local port or a unix socket:
+
+		python serve.py --experiment_dir experiments/01 --port 8000
+		curl -d '{"length": 100, "instrument": "Flute"}' localhost:8000/generate > out.mid
+
+	POST /generate takes a json object with
+		experiment   name of the experiment directory (default: the first one)
+		seed         MIDI pitches to start from, null for rests (default: a random
+		             window of --seed_bank or of the seed files in --data_dir)
+		seed_family  instrument family (or instrument) of the random seed window,
+		             needs --seed_bank
+		length       number of 16th notes to generate (default: 100)
+		instrument   General MIDI instrument name or program (default: Acoustic Grand Piano)
+		count        number of melodies to generate (default: 1)
+		temperature, top_k    see sample.py
+	and returns a MIDI file with one track per melody. GET /models lists the
+	loaded experiments.
+
+	All predict calls of a model run on a single worker thread. Requests that
+	arrive while it's busy, or within --max_wait ms of each other, are generated
+	together in one batch (up to --max_batch melodies), so concurrent requests
+	share every predict call instead of each running its own at batch size 1.
+"""
+import argparse, os, io, json, random, threading, time
+import socketserver
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from queue import Queue, Empty
+
+import numpy as np
+import pretty_midi
+
+import utils
+import data_utils
+import seed_bank
+
+
+def parse_args():
+	parser = argparse.ArgumentParser(
+		formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+	parser.add_argument('--experiment_dir', type=str, action='append', required=True,
+						help='directory of an experiment to serve. Can be given several ' \
+							 'times to serve several models.')
+	parser.add_argument('--port', type=int, default=8000,
+						help='local port to listen on.')
+	parser.add_argument('--host', type=str, default='127.0.0.1',
+						help='address to listen on.')
+	parser.add_argument('--socket', type=str,
+						help='listen on this unix socket instead of --port.')
+	parser.add_argument('--data_dir', type=str, default='data',
+						help='data directory containing .mid files to draw random seeds from.')
+	parser.add_argument('--seed_bank', type=str,
+						help='seed bank file (see seed_bank.py) to draw random seeds from ' \
+							 'instead of the files of --data_dir.')
+	parser.add_argument('--num_seed_files', type=int, default=10,
+						help='number of files of --data_dir to draw random seeds from.')
+	parser.add_argument('--ignore_empty', action='store_true',
+						help='Ignore empty seed windows.')
+	parser.add_argument('--max_batch', type=int, default=64,
+						help='maximum number of melodies generated together.')
+	parser.add_argument('--max_wait', type=float, default=20,
+						help='time in ms to wait for more requests before generating a batch.')
+	parser.add_argument('--max_length', type=int, default=4000,
+						help='largest length a request can ask for, in 16th notes.')
+	parser.add_argument('--max_count', type=int, default=64,
+						help='largest number of melodies a request can ask for.')
+	return parser.parse_args()
+
+
+class GenerationRequest(object):
+	'''A request for count melodies, answered by a Generator with a MIDI file'''
+
+	def __init__(self, seeds, length, program, temperature=1.0, top_k=None):
+		self.seeds = seeds
+		self.length = length
+		self.program = program
+		self.temperature = temperature
+		self.top_k = top_k
+		self.midi = None
+		self.error = None
+		self._done = threading.Event()
+
+	# requests can only share a batch if they generate the same number of steps
+	# (the track sections depend on it) with the same sampling
+	def batch_key(self):
+		return self.length, self.temperature, self.top_k
+
+	def finish(self, midi=None, error=None):
+		self.midi, self.error = midi, error
+		self._done.set()
+
+	def wait(self):
+		self._done.wait()
+		if self.error is not None:
+			raise self.error
+		return self.midi
+
+
+class Generator(object):
+	'''The model of an experiment and the worker thread that generates the
+	queued requests for it in batches'''
+
+	def __init__(self, experiment_dir, max_batch=64, max_wait=0.02):
+		self.experiment_dir = experiment_dir
+		self.use_instrument, self.encode_section = None, None
+		self.max_batch = max_batch
+		self.max_wait = max_wait
+		self.model, self.epoch, self.window_size = None, None, None
+		self._queue = Queue()
+		# a request that didn't fit into the previous batch, it starts the next one
+		self._held = None
+		self._loaded = threading.Event()
+		self._load_error = None
+		self._thread = threading.Thread(target=self._run)
+		self._thread.daemon = True
+		self._thread.start()
+
+	def wait_loaded(self):
+		self._loaded.wait()
+		if self._load_error is not None:
+			raise self._load_error
+
+	def submit(self, request):
+		self._queue.put(request)
+		return request.wait()
+
+	def _run(self):
+		# the model is loaded and only ever used on this thread
+		try:
+			self.model, self.epoch = utils.load_inference_model(self.experiment_dir)
+			self.window_size = utils.get_model_window_size(self.model)
+			# every experiment is served with the conditioning it was trained with
+			self.use_instrument, self.encode_section = utils.get_model_conditioning(self.model)
+		except Exception as e:
+			self._load_error = e
+		self._loaded.set()
+		if self._load_error is not None:
+			return
+
+		while True:
+			batch = self._next_batch()
+			groups = {}
+			for request in batch:
+				groups.setdefault(request.batch_key(), []).append(request)
+			for requests in groups.values():
+				try:
+					self._generate(requests)
+				except Exception as e:
+					for request in requests:
+						request.finish(error=e)
+
+	# blocks for a request, then collects all requests that are queued or
+	# arrive within max_wait, up to max_batch melodies. The first request that
+	# doesn't fit is held back for the next batch, so it keeps its place.
+	def _next_batch(self):
+		if self._held is not None:
+			batch, self._held = [self._held], None
+		else:
+			batch = [self._queue.get()]
+		num_seqs = len(batch[0].seeds)
+		deadline = time.time() + self.max_wait
+		while num_seqs < self.max_batch:
+			try:
+				request = self._queue.get(timeout=max(deadline - time.time(), 0))
+			except Empty:
+				break
+			if num_seqs + len(request.seeds) > self.max_batch:
+				self._held = request
+				break
+			batch.append(request)
+			num_seqs += len(request.seeds)
+		return batch
+
+	def _generate(self, requests):
+		seeds = np.concatenate([r.seeds for r in requests])
+		instruments = np.concatenate([
+			np.full(len(r.seeds), data_utils.get_family_id_by_instrument_normalized(r.program))
+			for r in requests])
+		first = requests[0]
+		generated = utils.generate_indices(self.model, seeds, first.length, instruments,
+										   self.use_instrument, self.encode_section,
+										   temperature=first.temperature, top_k=first.top_k)
+
+		start = 0
+		for request in requests:
+			midi = pretty_midi.PrettyMIDI()
+			for indices in generated[start:start + len(request.seeds)]:
+				midi.instruments.append(data_utils._network_output_to_instrument(
+					data_utils.indices_to_roll(indices), request.program))
+			start += len(request.seeds)
+			f = io.BytesIO()
+			midi.write(f)
+			request.finish(midi=f.getvalue())
+
+
+class SeedPool(object):
+	'''Random seed windows from the monophonic tracks of midi files, which are
+	parsed once, when the first seed is drawn'''
+
+	def __init__(self, midi_paths, ignore_empty=False):
+		self.midi_paths = midi_paths
+		self.ignore_empty = ignore_empty
+		self._tracks = {}
+		self._lock = threading.Lock()
+
+	def draw(self, window_size, count, family=None):
+		if family is not None:
+			raise ValueError('seed_family needs a server started with --seed_bank')
+		with self._lock:
+			if window_size not in self._tracks:
+				self._tracks[window_size] = self._load(window_size)
+		tracks, window_track, window_pos = self._tracks[window_size]
+		if len(window_pos) == 0:
+			raise ValueError('no seed windows of {} steps in the seed files'.format(window_size))
+		choice = np.random.randint(0, len(window_pos), count)
+		X, _ = data_utils.gather_track_windows(tracks, window_track[choice], window_pos[choice],
+											   window_size)
+		return X, None
+
+	def _load(self, window_size):
+		tracks = data_utils.load_midi_tracks(self.midi_paths, window_size)
+		window_track, window_pos = data_utils.build_window_index(tracks, window_size,
+																 self.ignore_empty)
+		return tracks, window_track, window_pos
+
+
+def _get_program(instrument):
+	try:
+		program = int(instrument)
+	except ValueError:
+		return pretty_midi.instrument_name_to_program(instrument)
+	if not 0 <= program <= 127:
+		raise ValueError('{} is not a supported instrument. Number values must be 0-127'
+						 .format(instrument))
+	return program
+
+
+# The seed windows of a request, from its MIDI pitches (None for rests) or
+# drawn from the seed pool (a SeedPool or a seed_bank.SeedBank)
+def _get_seeds(params, window_size, count, seed_pool):
+	seed = params.get('seed')
+	if seed is None:
+		seeds, _ = seed_pool.draw(window_size, count, params.get('seed_family'))
+		return seeds
+	if len(seed) < window_size:
+		raise ValueError('the seed needs at least {} steps'.format(window_size))
+	indices = np.array([0 if p is None else int(p) + 1 for p in seed[-window_size:]])
+	if np.any(indices < 0) or np.any(indices > 128):
+		raise ValueError('seed pitches must be 0-127 or null')
+	return np.tile(indices.astype(np.uint8), (count, 1))
+
+
+def make_handler(generators, seed_pool, max_length=4000, max_count=64):
+	default = next(iter(generators))
+
+	class Handler(BaseHTTPRequestHandler):
+
+		def do_GET(self):
+			if self.path != '/models':
+				return self._send_json(404, {'error': 'not found'})
+			self._send_json(200, {name: {'experiment_dir': g.experiment_dir,
+										 'epoch': g.epoch,
+										 'window_size': g.window_size,
+										 'use_instrument': g.use_instrument,
+										 'encode_section': g.encode_section}
+								  for name, g in generators.items()})
+
+		def do_POST(self):
+			if self.path != '/generate':
+				return self._send_json(404, {'error': 'not found'})
+			try:
+				length = int(self.headers.get('Content-Length', 0))
+				params = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+				generator = generators[params.get('experiment', default)]
+				count = int(params.get('count', 1))
+				if not 1 <= count <= max_count:
+					raise ValueError('count must be 1-{}'.format(max_count))
+				num_steps = int(params.get('length', 100))
+				if not 1 <= num_steps <= max_length:
+					raise ValueError('length must be 1-{}'.format(max_length))
+				temperature = float(params.get('temperature', 1.0))
+				if not temperature > 0:
+					raise ValueError('temperature must be positive')
+				top_k = None if params.get('top_k') is None else int(params['top_k'])
+				if top_k is not None and top_k < 1:
+					raise ValueError('top_k must be at least 1')
+				request = GenerationRequest(
+					_get_seeds(params, generator.window_size, count, seed_pool),
+					num_steps,
+					_get_program(params.get('instrument', 'Acoustic Grand Piano')),
+					temperature, top_k)
+			except KeyError as e:
+				return self._send_json(400, {'error': 'unknown experiment {}'.format(e)})
+			except (ValueError, TypeError) as e:
+				return self._send_json(400, {'error': str(e)})
+
+			try:
+				midi = generator.submit(request)
+			except Exception as e:
+				return self._send_json(500, {'error': str(e)})
+			self._send(200, 'audio/midi', midi)
+
+		def _send_json(self, status, data):
+			self._send(status, 'application/json', json.dumps(data).encode('utf-8'))
+
+		def _send(self, status, content_type, body):
+			self.send_response(status)
+			self.send_header('Content-Type', content_type)
+			self.send_header('Content-Length', str(len(body)))
+			self.end_headers()
+			self.wfile.write(body)
+
+		# unix socket clients have no address
+		def address_string(self):
+			return self.client_address[0] if self.client_address else self.server.server_address
+
+	return Handler
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, HTTPServer):
+	daemon_threads = True
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+	daemon_threads = True
+
+
+def main():
+	args = parse_args()
+	# a single request has to fit into a batch
+	if args.max_count > args.max_batch:
+		utils.log('Error: --max_count can\'t be larger than --max_batch. Exiting.', True)
+		exit(1)
+
+	generators = {}
+	for experiment_dir in args.experiment_dir:
+		name = os.path.basename(os.path.normpath(experiment_dir))
+		generators[name] = Generator(experiment_dir, args.max_batch, args.max_wait / 1000.)
+	for name, generator in generators.items():
+		generator.wait_loaded()
+		utils.log('Model {} loaded from {} (epoch {})'.format(
+			name, generator.experiment_dir, generator.epoch), True)
+
+	if args.seed_bank:
+		seed_pool = seed_bank.load(args.seed_bank)
+		utils.log('Loaded {} seeds from {}'.format(len(seed_pool), args.seed_bank), True)
+	else:
+		midi_files = [os.path.join(args.data_dir, f) for f in os.listdir(args.data_dir) \
+					  if '.mid' in f or '.midi' in f] if os.path.isdir(args.data_dir) else []
+		random.shuffle(midi_files)
+		seed_pool = SeedPool(midi_files[:args.num_seed_files], args.ignore_empty)
+
+	handler = make_handler(generators, seed_pool, args.max_length, args.max_count)
+	if args.socket:
+		if os.path.exists(args.socket):
+			os.remove(args.socket)
+		server = ThreadingUnixHTTPServer(args.socket, handler)
+		utils.log('Listening on {}'.format(args.socket), True)
+	else:
+		server = ThreadingHTTPServer((args.host, args.port), handler)
+		utils.log('Listening on http://{}:{}'.format(args.host, args.port), True)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		server.server_close()
+
+
+if __name__ == '__main__':
+	main()
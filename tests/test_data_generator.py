@@ -0,0 +1,54 @@
+import numpy as np
+import pretty_midi
+
+import data_utils
+
+
+def _write_midi(path, num_notes, program=0):
+	midi = pretty_midi.PrettyMIDI()
+	instrument = pretty_midi.Instrument(program=program)
+	for i in range(num_notes):
+		instrument.notes.append(pretty_midi.Note(velocity=100, pitch=40 + i % 30,
+												 start=i * 0.25, end=(i + 1) * 0.25))
+	midi.instruments.append(instrument)
+	midi.write(path)
+
+
+def _midi_files(tmp_path):
+	paths = []
+	for i in range(7):
+		path = str(tmp_path / '{}.mid'.format(i))
+		_write_midi(path, 40 + 9 * i, program=i * 8)
+		paths.append(path)
+	return paths
+
+
+def test_passes_yield_the_counted_windows(tmp_path):
+	paths = _midi_files(tmp_path)
+	num_windows = data_utils.count_midi_windows(paths, 20, num_threads=2)
+
+	tracks = data_utils.load_midi_tracks(paths, 20)
+	events, starts, _, _ = data_utils._window_index_from_tracks(tracks, 20)
+	assert num_windows == len(starts)
+
+	# chunks of 3 files leave windows that don't fill a batch, they are carried
+	# into the next chunk, so two passes yield all of their windows in order
+	batch_size = 16
+	generator = data_utils.get_data_generator(paths, 20, batch_size, num_threads=1,
+											  max_files_in_ram=3)
+	batches = [next(generator) for _ in range(2 * num_windows // batch_size)]
+	generated = np.concatenate([np.argmax(X, axis=2) for X, _ in batches])
+	X, _ = data_utils._gather_windows(events, starts, 20)
+	expected = np.concatenate([X, X])[:len(generated)]
+	assert np.array_equal(generated, expected)
+	generator.close()
+
+
+def test_closing_the_generator_stops_its_workers(tmp_path):
+	import multiprocessing
+	paths = _midi_files(tmp_path)
+	generator = data_utils.get_data_generator(paths, 20, 8, num_threads=2, max_files_in_ram=3)
+	next(generator)
+	assert len(multiprocessing.active_children()) >= 2
+	generator.close()
+	assert len(multiprocessing.active_children()) == 0
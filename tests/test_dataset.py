@@ -0,0 +1,75 @@
+import json
+import os
+
+import numpy as np
+
+import dataset
+import prep_data_pickle
+
+
+def _write_v1_dataset(path, tracks):
+	'''A dataset directory as the first version wrote it: a single index.npy and
+	a meta.json without a manifest'''
+	os.makedirs(path)
+	sources = sorted(set(source for _, source in tracks))
+	rows, offset = [], 0
+	with open(os.path.join(path, 'events.bin'), 'wb') as f:
+		for indices, source in tracks:
+			f.write(np.asarray(indices, dtype=np.uint8).tobytes())
+			rows.append((offset, len(indices), 0.5, sources.index(source)))
+			offset += len(indices)
+	np.save(os.path.join(path, 'index.npy'), np.array(rows, dtype=dataset.INDEX_DTYPE))
+	with open(os.path.join(path, 'meta.json'), 'w') as f:
+		json.dump({'version': 1, 'sources': sources}, f)
+
+
+def _midi_files(tmp_path, names):
+	data_dir = tmp_path / 'data'
+	data_dir.mkdir()
+	paths = []
+	for name in names:
+		path = str(data_dir / name)
+		with open(path, 'wb') as f:
+			f.write(name.encode('utf-8'))
+		paths.append(path)
+	return paths
+
+
+def test_updating_a_v1_dataset_replaces_its_tracks(tmp_path):
+	paths = _midi_files(tmp_path, ['a.mid', 'b.mid'])
+	path = str(tmp_path / 'dataset')
+	_write_v1_dataset(path, [([1, 2, 3], paths[0]), ([4, 5], paths[0]), ([6, 7], paths[1])])
+
+	writer = dataset.DatasetWriter(path)
+	assert writer.files == {paths[0]: {'tracks': 2}, paths[1]: {'tracks': 1}}
+	pending, _ = prep_data_pickle.sync_manifest(writer, paths[:1])
+	# the files can't be compared with the tracks of the dataset, so they are
+	# prepared again instead of being added a second time
+	assert pending == paths[:1]
+	for indices in ([1, 2, 3], [4, 5]):
+		writer.add_track(indices, 0.5, paths[0])
+	writer.close()
+
+	tracks = dataset.load_tracks(path)
+	assert [list(t['indices']) for t in tracks] == [[1, 2, 3], [4, 5]]
+	assert all(t['source'] == paths[0] for t in tracks)
+
+
+def test_commit_keeps_the_previous_index(tmp_path):
+	path = str(tmp_path / 'dataset')
+	writer = dataset.DatasetWriter(path)
+	indices = []
+	for i in range(4):
+		writer.add_track([i + 1] * 3, 0.5, 'source{}'.format(i))
+		writer.commit()
+		with open(os.path.join(path, 'meta.json')) as f:
+			indices.append(json.load(f)['index'])
+		names = sorted(n for n in os.listdir(path) if n.endswith('.npy'))
+		assert names == sorted(indices[-2:])
+	writer.close()
+
+	# a reader that read meta.json before the last commit opens the index it
+	# points to
+	previous = np.load(os.path.join(path, indices[-1]), mmap_mode='r')
+	assert len(previous) == 4
+	assert len(dataset.load_tracks(path)) == 4
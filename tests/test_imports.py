@@ -0,0 +1,43 @@
+"""
+	Startup regression test: the data and sampling modules must import without
+	keras or a backend, from any working directory, and quickly
+"""
+import os
+import subprocess
+import sys
+import tempfile
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# seconds the data modules may take to import. Importing keras with a backend
+# takes several seconds, the data modules a few hundred milliseconds.
+IMPORT_BUDGET = 1.5
+
+SCRIPT = '''
+import sys, time
+start = time.time()
+import data_utils, prep_data_pickle
+print(time.time() - start)
+import utils, sample, seed_bank, serve
+assert 'keras' not in sys.modules, 'keras was imported'
+assert 'tensorflow' not in sys.modules, 'tensorflow was imported'
+# instruments.json is found next to data_utils, not in the working directory
+print(data_utils.get_family_id_by_instrument_normalized(0))
+'''
+
+
+def _run(script):
+	env = dict(os.environ, PYTHONPATH=REPO_DIR)
+	with tempfile.TemporaryDirectory() as cwd:
+		result = subprocess.run([sys.executable, '-c', script], cwd=cwd, env=env,
+								stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+								universal_newlines=True)
+	assert result.returncode == 0, result.stderr
+	return result.stdout.split()
+
+
+def test_imports_without_keras():
+	import_time, family = _run(SCRIPT)
+	assert float(family) == 0.0
+	assert float(import_time) < IMPORT_BUDGET, \
+		'importing data_utils and prep_data_pickle took {:.2f}s'.format(float(import_time))
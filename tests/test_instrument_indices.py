@@ -0,0 +1,94 @@
+"""
+	The note sweep of get_instrument_indices and get_notes_percent_monophonic
+	against the piano roll of pretty_midi they replace
+"""
+import numpy as np
+import pretty_midi
+import pytest
+
+import data_utils
+
+
+# get_instrument_roll as it was before the pitch indices: the velocity roll at
+# fs=4 without its leading silence, with a rest column in front that is set
+# for steps without exactly one note. It failed on instruments without any
+# steps, which now have an empty track.
+def _old_instrument_roll(pm_instrument):
+	roll = np.copy(pm_instrument.get_piano_roll(fs=4).T)
+	if len(roll) == 0:
+		return np.zeros((0, data_utils.NUM_CLASSES))
+	summed = np.sum(roll, axis=1)
+	roll = roll[np.argmax((summed > 0).astype(float)):]
+	roll = (roll > 0).astype(float)
+	rests = (np.sum(roll, axis=1) != 1).astype(float)
+	return np.insert(roll, 0, rests, axis=1)
+
+
+def _instrument(notes, is_drum=False, pitch_bends=(), control_changes=()):
+	instrument = pretty_midi.Instrument(program=0, is_drum=is_drum)
+	instrument.notes = [pretty_midi.Note(velocity=v, pitch=p, start=s, end=e)
+						for p, s, e, v in notes]
+	instrument.pitch_bends = [pretty_midi.PitchBend(pitch, time) for pitch, time in pitch_bends]
+	instrument.control_changes = [pretty_midi.ControlChange(number, value, time)
+								  for number, value, time in control_changes]
+	return instrument
+
+
+MELODY = [(60, 0.5, 1.0, 100), (62, 1.0, 1.5, 100), (64, 2.0, 3.1, 90), (65, 3.3, 3.6, 80)]
+
+INSTRUMENTS = {
+	'melody': _instrument(MELODY),
+	'chords': _instrument(MELODY + [(67, 0.7, 1.2, 100), (48, 2.5, 4.0, 100)]),
+	'overlapping same pitch': _instrument([(60, 0.0, 1.0, 100), (60, 0.5, 1.5, 100),
+										   (60, 1.2, 1.3, 100), (62, 1.5, 2.0, 100),
+										   (62, 1.75, 2.8, 100), (64, 2.2, 2.4, 100)]),
+	'zero length notes': _instrument(MELODY + [(70, 1.2, 1.2, 100), (71, 4.0, 4.0, 100),
+											   (72, 0.5, 0.5, 100)]),
+	'zero velocity notes': _instrument(MELODY + [(70, 1.1, 1.9, 0)]),
+	'only zero length notes': _instrument([(60, 1.0, 1.0, 100)]),
+	'no notes': _instrument([]),
+	'drums': _instrument(MELODY, is_drum=True),
+	'drums with sustain': _instrument(MELODY, is_drum=True,
+									  control_changes=[(64, 127, 0.1), (64, 0, 3.0)]),
+	'pitch bend': _instrument(MELODY, pitch_bends=[(2000, 1.1), (0, 2.1)]),
+	'sustain': _instrument(MELODY, control_changes=[(64, 127, 0.9), (64, 0, 2.6)]),
+	'released sustain': _instrument(MELODY, control_changes=[(64, 20, 0.9)]),
+	'zero pitch bend': _instrument(MELODY, pitch_bends=[(0, 1.1)]),
+	'late control change': _instrument(MELODY, control_changes=[(7, 100, 6.0)]),
+}
+
+
+@pytest.mark.parametrize('name', sorted(INSTRUMENTS))
+def test_percent_monophonic_matches_the_piano_roll(name):
+	instrument = INSTRUMENTS[name]
+	expected = data_utils.get_percent_monophonic(instrument.get_piano_roll())
+	assert data_utils.get_notes_percent_monophonic(instrument) == expected
+
+
+@pytest.mark.parametrize('name', sorted(INSTRUMENTS))
+def test_indices_match_the_piano_roll(name):
+	instrument = INSTRUMENTS[name]
+	expected = np.argmax(_old_instrument_roll(instrument), axis=1)
+	indices = data_utils.get_instrument_indices(instrument)
+	assert indices.dtype == np.uint8
+	np.testing.assert_array_equal(indices, expected)
+
+
+def test_random_instruments_match_the_piano_roll():
+	rng = np.random.RandomState(0)
+	for _ in range(50):
+		starts = np.round(rng.uniform(0, 8, 30), 2)
+		lengths = np.round(rng.exponential(0.4, 30), 2) * (rng.uniform(size=30) > 0.1)
+		notes = [(int(p), s, s + l, 100)
+				 for p, s, l in zip(rng.randint(55, 65, 30), starts, lengths)]
+		instrument = _instrument(notes)
+		assert data_utils.get_notes_percent_monophonic(instrument) == \
+			   data_utils.get_percent_monophonic(instrument.get_piano_roll())
+		np.testing.assert_array_equal(data_utils.get_instrument_indices(instrument),
+									  np.argmax(_old_instrument_roll(instrument), axis=1))
+
+
+def test_bends_and_sustain_fall_back_to_the_piano_roll():
+	altered = [name for name in sorted(INSTRUMENTS)
+			   if data_utils._roll_alters_notes(INSTRUMENTS[name])]
+	assert altered == ['pitch bend', 'sustain']
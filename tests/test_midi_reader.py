@@ -0,0 +1,99 @@
+"""
+	read_midi against pretty_midi on small generated midi files
+"""
+import mido
+import pytest
+
+import midi_reader
+
+
+def _track(events):
+	'''A mido track from (tick, message) pairs, sorted by tick'''
+	track = mido.MidiTrack()
+	tick = 0
+	for event_tick, message in sorted(events, key=lambda e: e[0]):
+		track.append(message.copy(time=event_tick - tick))
+		tick = event_tick
+	return track
+
+
+def _notes(pitches, start=0, length=120, channel=0, velocity=100):
+	events = []
+	for i, pitch in enumerate(pitches):
+		events.append((start + i * length, mido.Message('note_on', note=pitch, velocity=velocity,
+														channel=channel)))
+		events.append((start + (i + 1) * length, mido.Message('note_off', note=pitch, channel=channel)))
+	return events
+
+
+def _write(path, tracks, ticks_per_beat=480):
+	midi = mido.MidiFile(ticks_per_beat=ticks_per_beat)
+	midi.tracks.extend(_track(events) for events in tracks)
+	midi.save(path)
+	return path
+
+
+def _tempo(tick, bpm):
+	return tick, mido.MetaMessage('set_tempo', tempo=mido.bpm2tempo(bpm))
+
+
+def _control(tick, number, value, channel=0):
+	return tick, mido.Message('control_change', control=number, value=value, channel=channel)
+
+
+MELODY = [60, 62, 64, 65, 67, 65, 64, 62]
+
+FILES = {
+	# tempo changes on the first track, including one at tick 0, a repeated
+	# tempo and one in the middle of a note
+	'tempo changes': [
+		[_tempo(0, 100), _tempo(480, 140), _tempo(960, 140), _tempo(1020, 75)],
+		_notes(MELODY) + _notes(MELODY, start=1100, length=90)],
+	# tempo changes on other tracks are ignored
+	'tempo change on a later track': [
+		[_tempo(0, 90)],
+		_notes(MELODY) + [_tempo(600, 200)]],
+	# a note-on of a pitch at the tick of its note-off, in both orders, and a
+	# note-on with velocity 0 as note-off
+	'note-on at the note-off tick': [[
+		(0, mido.Message('note_on', note=60, velocity=100)),
+		(120, mido.Message('note_off', note=60)),
+		(120, mido.Message('note_on', note=60, velocity=90)),
+		(240, mido.Message('note_on', note=60, velocity=80)),
+		(240, mido.Message('note_off', note=60)),
+		(360, mido.Message('note_on', note=60, velocity=0)),
+		(480, mido.Message('note_on', note=62, velocity=100)),
+		(480, mido.Message('note_on', note=62, velocity=70)),
+		(600, mido.Message('note_off', note=62)),
+		(720, mido.Message('note_off', note=62)),
+		(720, mido.Message('note_off', note=64)),
+	]],
+	# control changes and pitch bends before the first note of a channel,
+	# after its last one and on channels without notes
+	'straggler control changes': [[
+		_control(0, 7, 100),
+		_control(0, 64, 127, channel=1),
+		(10, mido.Message('pitchwheel', pitch=1000)),
+		(0, mido.Message('program_change', program=40)),
+		_control(30, 10, 64, channel=2),
+	] + _notes(MELODY) + [
+		_control(2000, 64, 0),
+		(2400, mido.Message('pitchwheel', pitch=0)),
+		_control(3000, 11, 90, channel=3),
+	]],
+	# programs, drums and several channels per track
+	'programs and drums': [
+		[],
+		[(0, mido.Message('program_change', program=25))] + _notes(MELODY) +
+		[(480, mido.Message('program_change', program=73))] + _notes(MELODY, start=1000),
+		_notes([36, 38, 42, 36], channel=9) + _notes(MELODY[::-1], channel=4, length=60)],
+}
+
+
+# pretty_midi warns about the tempo change on a later track
+@pytest.mark.filterwarnings('ignore:Tempo, Key or Time signature')
+@pytest.mark.parametrize('name', sorted(FILES))
+def test_reads_the_notes_of_pretty_midi(name, tmp_path):
+	path = _write(str(tmp_path / 'test.mid'), FILES[name])
+	assert midi_reader.read_midi(path).instruments, 'no instruments were read'
+	assert midi_reader.compare_with_pretty_midi(path) == []
@@ -0,0 +1,47 @@
+import argparse
+
+import numpy as np
+import pytest
+
+keras = pytest.importorskip('keras')
+
+import data_utils
+import numpy_model
+import train
+import utils
+
+
+def _get_model(**kwargs):
+	args = dict(window_size=8, rnn_size=16, num_layers=2, dropout=0.2, embedding_size=6,
+				use_simple=False, use_embedding=False, use_instrument=False,
+				encode_section=False)
+	args.update(kwargs)
+	model, _ = train.get_model(argparse.Namespace(**args))
+	return model
+
+
+def _inputs(model, use_instrument, encode_section, batch_size=5):
+	X = np.random.randint(0, data_utils.NUM_CLASSES, (batch_size, 8)).astype(np.uint8)
+	instruments = np.random.randint(0, 16, batch_size) / 16.
+	sections = np.random.randint(0, 4, batch_size)
+	return data_utils._encode_input(X, instruments, sections, use_instrument, encode_section,
+									sparse=utils.model_uses_embedding(model))
+
+
+@pytest.mark.parametrize('kwargs', [
+	dict(),
+	dict(use_simple=True, use_instrument=True),
+	dict(use_instrument=True, encode_section=True),
+	dict(use_embedding=True),
+	dict(use_embedding=True, use_simple=True, use_instrument=True, encode_section=True),
+])
+def test_predict_matches_keras(tmp_path, kwargs):
+	model = _get_model(**kwargs)
+	path = str(tmp_path / 'model.npz')
+	numpy_model.export_model(model, path)
+	exported = numpy_model.load_model(path)
+
+	arr = _inputs(model, kwargs.get('use_instrument', False), kwargs.get('encode_section', False))
+	expected = model.predict(arr, verbose=0)
+	assert exported.input_shape == model.input_shape
+	assert np.allclose(exported.predict(arr), expected, atol=1e-5)
@@ -0,0 +1,65 @@
+import os
+from functools import partial
+from multiprocessing import Pool
+
+import numpy as np
+
+from roll_cache import RollCache
+
+TRACK_LENGTH = 1000
+
+
+def _fake_tracks(path, window_size):
+	return [{'indices': np.full(TRACK_LENGTH, 1, dtype=np.uint8), 'instrument': 0.0}]
+
+
+def _load(path, cache):
+	return len(cache.load_tracks(path, 20, _fake_tracks))
+
+
+def _cache_size(cache_dir):
+	return sum(os.path.getsize(os.path.join(cache_dir, name)) for name in os.listdir(cache_dir)
+			   if name.endswith('.json') or name.endswith('.npy'))
+
+
+def test_size_limit_holds_across_worker_processes(tmp_path):
+	paths = []
+	for i in range(200):
+		path = str(tmp_path / '{}.mid'.format(i))
+		with open(path, 'w') as f:
+			f.write(str(i))
+		paths.append(path)
+
+	# room for about 50 entries
+	max_size = 50 * (TRACK_LENGTH + 200)
+	cache_dir = str(tmp_path / 'cache')
+	cache = RollCache(cache_dir, max_size)
+	pool = Pool(2)
+	try:
+		assert sum(pool.map(partial(_load, cache=cache), paths, chunksize=4)) == len(paths)
+	finally:
+		pool.close()
+		pool.join()
+
+	assert 0 < _cache_size(cache_dir) <= max_size
+	# an entry written during another process' eviction scan can be counted
+	# twice, so the size file is an upper bound of the cache size
+	with open(os.path.join(cache_dir, 'size')) as f:
+		assert int(f.read()) >= _cache_size(cache_dir)
+
+
+def test_cached_tracks_are_served(tmp_path):
+	path = str(tmp_path / 'a.mid')
+	with open(path, 'w') as f:
+		f.write('a')
+	cache = RollCache(str(tmp_path / 'cache'))
+	calls = []
+
+	def load_fn(path, window_size):
+		calls.append(path)
+		return _fake_tracks(path, window_size)
+
+	first = cache.load_tracks(path, 20, load_fn)
+	second = cache.load_tracks(path, 20, load_fn)
+	assert len(calls) == 1
+	assert np.array_equal(first[0]['indices'], second[0]['indices'])
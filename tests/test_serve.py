@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+import serve
+
+
+def _request(count):
+	return serve.GenerationRequest(np.zeros((count, 4), dtype=np.uint8), 10, 0)
+
+
+def _generator(max_batch):
+	# the model fails to load, which leaves the queue to the test
+	generator = serve.Generator('/nonexistent', max_batch=max_batch, max_wait=0.01)
+	with pytest.raises(Exception):
+		generator.wait_loaded()
+	return generator
+
+
+def test_batches_stay_within_max_batch():
+	generator = _generator(max_batch=8)
+	counts = [5, 2, 4, 8, 1, 3]
+	for count in counts:
+		generator._queue.put(_request(count))
+
+	batches = []
+	while sum(len(b) for b in batches) < len(counts):
+		batches.append([len(r.seeds) for r in generator._next_batch()])
+	assert batches == [[5, 2], [4], [8], [1, 3]]
+	assert generator._held is None
@@ -1,18 +1,14 @@
 #!/usr/bin/env python
 import json
 import os, argparse, time
-import pickle
-import random
 
 import utils
+import data_utils
+import dataset
+import checkpoint_index
+from roll_cache import RollCache
 from utils import log
-from keras.models import Sequential
-from keras.layers import Dense, Activation, Dropout
-from keras.layers import LSTM
-from keras.callbacks import ModelCheckpoint, ReduceLROnPlateau, TensorBoard
-from keras.optimizers import SGD, RMSprop, Adagrad, Adadelta, Adam, Adamax, Nadam
-
-OUTPUT_SIZE = 129  # 0-127 notes + 1 for rests
+from data_utils import NUM_CLASSES
 
 
 def parse_args():
@@ -58,6 +54,23 @@ def parse_args():
 						help='The maximum number of midi files to load into RAM at once.' \
 							 ' A higher value trains faster but uses more RAM. A lower value ' \
 							 'uses less RAM but takes significantly longer to train.')
+	parser.add_argument('--prefetch_depth', default=16, type=int,
+						help='Number of batches fit_generator prepares ahead of training ' \
+							 '(its max_queue_size). The next chunk of files is always parsed ' \
+							 'in the background.')
+	parser.add_argument('--workers', default=1, type=int,
+						help='Number of workers preparing batches. More than 1 worker ' \
+							 'indexes the whole training set up front and serves it as a ' \
+							 'keras Sequence.')
+	parser.add_argument('--use_multiprocessing', action='store_true',
+						help='Prepare batches in worker processes instead of threads.')
+	parser.add_argument('--roll_cache_dir', type=str, default='roll-cache',
+						help='Directory to cache the parsed tracks of midi files in when ' \
+							 'training without prepared data, so they are only parsed once. ' \
+							 'An empty value disables the cache.')
+	parser.add_argument('--roll_cache_size', type=int, default=2048,
+						help='Maximum size of --roll_cache_dir in MB. The least recently ' \
+							 'used files are evicted first.')
 	parser.add_argument('--use_instrument', action='store_true',
 						help='Use instrument type in input.')
 	parser.add_argument('--ignore_empty', action='store_true',
@@ -66,66 +79,94 @@ def parse_args():
 						help='Encode source track sections.')
 	parser.add_argument('--use_simple', action='store_true',
 						help='Use the basic network architecture')
+	parser.add_argument('--use_embedding', action='store_true',
+						help='Feed integer pitch indices through an embedding layer ' \
+							 'and train on sparse targets instead of one-hot vectors.')
+	parser.add_argument('--embedding_size', type=int, default=32,
+						help='size of the pitch embedding used with --use_embedding')
 	parser.add_argument('--pickle_file', type=str, default=None,
 						help='Load training data from given pickle file if this param is set')
+	parser.add_argument('--dataset_dir', type=str, default=None,
+						help='Load training data from a dataset directory created by ' \
+							 'prep_data_pickle.py if this param is set')
 	return parser.parse_args()
 
 
 # create or load a saved model
 # returns the model and the epoch number (>1 if loaded from checkpoint)
 def get_model(args, experiment_dir=None):
+	# keras is imported here, so importing this module stays cheap
+	from keras.models import Sequential
+	from keras.layers import Dense, Activation, Dropout, LSTM
+	from keras.optimizers import SGD, RMSprop, Adagrad, Adadelta, Adam, Adamax, Nadam
+
 	epoch = 0
 
 	if not experiment_dir:
-		model = Sequential()
-
-		input_size = OUTPUT_SIZE
+		num_conditioning = 0
 		if args.use_instrument:
-			input_size += 1  # Add 1 instrument input
+			num_conditioning += 1  # Add 1 instrument input
 		if args.encode_section:
-			input_size += 4  # Add 4 section inputs
+			num_conditioning += 4  # Add 4 section inputs
+
+		if args.use_embedding:
+			# the embedded pitch indices are the input of the first layer
+			input_shape = None
+		else:
+			input_shape = (args.window_size, NUM_CLASSES + num_conditioning)
 
+		layers = []
 		if args.use_simple:
 			for layer_index in range(args.num_layers):
 				kwargs = dict()
 				kwargs['units'] = args.rnn_size
 				# if this is the first layer
 				if layer_index == 0:
-					kwargs['input_shape'] = (args.window_size, input_size)
+					if input_shape:
+						kwargs['input_shape'] = input_shape
 					if args.num_layers == 1:
 						kwargs['return_sequences'] = False
 					else:
 						kwargs['return_sequences'] = True
-					model.add(LSTM(**kwargs))
+					layers.append(LSTM(**kwargs))
 				else:
 					# if this is a middle layer
 					if not layer_index == args.num_layers - 1:
 						kwargs['return_sequences'] = True
-						model.add(LSTM(**kwargs))
+						layers.append(LSTM(**kwargs))
 					else:  # this is the last layer
 						kwargs['return_sequences'] = False
-						model.add(LSTM(**kwargs))
-				model.add(Dropout(args.dropout))
+						layers.append(LSTM(**kwargs))
+				layers.append(Dropout(args.dropout))
 
-			model.add(Dense(OUTPUT_SIZE))
-			model.add(Activation('softmax'))
+			layers.append(Dense(NUM_CLASSES))
+			layers.append(Activation('softmax'))
 		else:
-			model.add(LSTM(
+			kwargs = {'input_shape': input_shape} if input_shape else {}
+			layers.append(LSTM(
 				units=args.rnn_size,
 				return_sequences=True,
-				input_shape=(args.window_size, input_size)
+				**kwargs
 			))
-			model.add(Dropout(rate=args.dropout))
+			layers.append(Dropout(rate=args.dropout))
 
-			model.add(LSTM(units=args.rnn_size * 2, return_sequences=True))  # 512
-			model.add(Dropout(rate=args.dropout))
+			layers.append(LSTM(units=args.rnn_size * 2, return_sequences=True))  # 512
+			layers.append(Dropout(rate=args.dropout))
 
-			model.add(LSTM(units=args.rnn_size, return_sequences=False))  # 256
-			model.add(Dense(units=args.rnn_size))  # 256
-			model.add(Dropout(rate=args.dropout))
+			layers.append(LSTM(units=args.rnn_size, return_sequences=False))  # 256
+			layers.append(Dense(units=args.rnn_size))  # 256
+			layers.append(Dropout(rate=args.dropout))
 
-			model.add(Dense(OUTPUT_SIZE))
-			model.add(Activation('softmax'))
+			layers.append(Dense(NUM_CLASSES))
+			layers.append(Activation('softmax'))
+
+		if args.use_embedding:
+			model = get_embedding_model(layers, args.window_size,
+										args.embedding_size, num_conditioning)
+		else:
+			model = Sequential()
+			for layer in layers:
+				model.add(layer)
 
 	else:
 		model, epoch = utils.load_model_from_checkpoint(experiment_dir)
@@ -161,13 +202,44 @@ def get_model(args, experiment_dir=None):
 	else:  # so instead lets use a default (no training occurs anyway)
 		optimizer = Adam()
 
-	model.compile(loss='categorical_crossentropy',
+	# models with an embedding input are trained on pitch indices
+	if utils.model_uses_embedding(model):
+		loss = 'sparse_categorical_crossentropy'
+	else:
+		loss = 'categorical_crossentropy'
+
+	model.compile(loss=loss,
 				  optimizer=optimizer,
 				  metrics=['accuracy'])
 	return model, epoch
 
 
+# Model taking a window of integer pitch indices (and the conditioning
+# features of the window as a separate input) instead of one-hot vectors.
+# The embedded notes are fed through the given layers.
+def get_embedding_model(layers, window_size, embedding_size, num_conditioning=0):
+	from keras.models import Model
+	from keras.layers import Input, Embedding, RepeatVector, concatenate
+
+	notes = Input(shape=(window_size,), dtype='int32', name='notes')
+	inputs = [notes]
+	x = Embedding(NUM_CLASSES, embedding_size)(notes)
+
+	if num_conditioning > 0:
+		# section and instrument inputs of the window, repeated for every step
+		# in the same order as in the one-hot input
+		conditioning = Input(shape=(num_conditioning,), name='conditioning')
+		inputs.append(conditioning)
+		x = concatenate([RepeatVector(window_size)(conditioning), x])
+
+	for layer in layers:
+		x = layer(x)
+	return Model(inputs=inputs, outputs=x)
+
+
 def get_callbacks(experiment_dir, checkpoint_monitor='val_acc'):
+	from keras.callbacks import ModelCheckpoint, ReduceLROnPlateau, TensorBoard, LambdaCallback
+
 	callbacks = []
 
 	#03: simple rs
@@ -187,6 +259,12 @@ def get_callbacks(experiment_dir, checkpoint_monitor='val_acc'):
 									 save_best_only=False,
 									 mode='max'))
 
+	# record every saved checkpoint and the metrics of its epoch in the manifest
+	# of the experiment and the experiments index, see checkpoint_index.py
+	callbacks.append(LambdaCallback(
+		on_epoch_end=lambda epoch, logs: checkpoint_index.record_checkpoint(
+			experiment_dir, filepath.format(epoch=epoch + 1), epoch + 1, logs)))
+
 	callbacks.append(ReduceLROnPlateau(monitor='val_loss',
 									   factor=0.5,
 									   patience=3,
@@ -220,32 +298,46 @@ def main():
 	val_split = 0.3  # use 30 percent for validation
 	num_tracks = 0
 
-	if args.pickle_file is not None:
-		if not os.path.exists(args.pickle_file):
-			utils.log('Error: pickle file {} does not exist. Exiting.'.format(args.pickle_file), True)
+	# Sequences map batch indices to batches, so they can be prepared by
+	# several workers. Generators lazy load the data in chunks instead.
+	use_sequences = args.workers > 1 or args.use_multiprocessing
+	if use_sequences:
+		import sequences
+	data_kwargs = dict(window_size=args.window_size,
+					   batch_size=args.batch_size,
+					   use_instrument=args.use_instrument,
+					   ignore_empty=args.ignore_empty,
+					   encode_section=args.encode_section,
+					   sparse=args.use_embedding)
+
+	prepared_data = args.dataset_dir or args.pickle_file
+	if prepared_data is not None:
+		if not os.path.exists(prepared_data):
+			utils.log('Error: prepared data {} does not exist. Exiting.'.format(prepared_data), True)
 			exit(1)
-		with open(args.pickle_file, 'rb') as file:
-			tracks = pickle.load(file)
-			random.shuffle(tracks)  # individual tracks can be randomized
+		# individual tracks can be randomized
+		tracks = dataset.load_tracks(prepared_data, shuffle=True)
 
 		num_tracks = len(tracks)
 		val_split_index = int(float(num_tracks) * val_split)
 
-		train_generator = utils.get_prepared_data_generator(tracks[val_split_index:],
-												   window_size=args.window_size,
-												   batch_size=args.batch_size,
-												   use_instrument=args.use_instrument,
-												   ignore_empty=args.ignore_empty,
-												   encode_section=args.encode_section,
-													max_tracks_in_ram=args.max_files_in_ram)
-		val_generator = utils.get_prepared_data_generator(tracks[0:val_split_index],
-												   window_size=args.window_size,
-												   batch_size=args.batch_size,
-												   use_instrument=args.use_instrument,
-												   ignore_empty=args.ignore_empty,
-												   encode_section=args.encode_section,
-													max_tracks_in_ram=args.max_files_in_ram,
-														  shuffle_batches=True)
+		if use_sequences:
+			train_generator = sequences.PreparedSequence(tracks[val_split_index:], **data_kwargs)
+			val_generator = sequences.PreparedSequence(tracks[0:val_split_index], **data_kwargs)
+		else:
+			# the window index gives the exact number of windows per split
+			train_index = data_utils.build_window_index(tracks[val_split_index:], args.window_size,
+												   args.ignore_empty)
+			val_index = data_utils.build_window_index(tracks[0:val_split_index], args.window_size,
+												 args.ignore_empty)
+			num_train_windows, num_val_windows = len(train_index[1]), len(val_index[1])
+
+			train_generator = data_utils.get_prepared_data_generator(tracks[val_split_index:],
+																window_index=train_index,
+																**data_kwargs)
+			val_generator = data_utils.get_prepared_data_generator(tracks[0:val_split_index],
+															  window_index=val_index,
+															  **data_kwargs)
 	else:
 		try:
 			# get paths to midi files in --data_dir
@@ -271,25 +363,40 @@ def main():
 		num_tracks = len(midi_files)
 		val_split_index = int(float(num_tracks) * val_split)
 
-		# use generators to lazy load train/validation data, ensuring that the
-		# user doesn't have to load all midi files into RAM at once
-		train_generator = utils.get_data_generator(midi_files[0:val_split_index],
-												   window_size=args.window_size,
-												   batch_size=args.batch_size,
-												   num_threads=args.n_jobs,
-												   use_instrument=args.use_instrument,
-												   ignore_empty=args.ignore_empty,
-												   encode_section=args.encode_section,
-												   max_files_in_ram=args.max_files_in_ram)
-
-		val_generator = utils.get_data_generator(midi_files[val_split_index:],
-												 window_size=args.window_size,
-												 batch_size=args.batch_size,
-												 num_threads=args.n_jobs,
-												 use_instrument=args.use_instrument,
-												 ignore_empty=args.ignore_empty,
-												 encode_section=args.encode_section,
-												 max_files_in_ram=args.max_files_in_ram)
+		cache = None
+		if args.roll_cache_dir:
+			cache = RollCache(args.roll_cache_dir, args.roll_cache_size * 1024 * 1024)
+
+		if use_sequences:
+			train_generator = sequences.MidiSequence(midi_files[0:val_split_index],
+													 num_threads=args.n_jobs, cache=cache,
+													 **data_kwargs)
+			val_generator = sequences.MidiSequence(midi_files[val_split_index:],
+												   num_threads=args.n_jobs, cache=cache,
+												   **data_kwargs)
+		else:
+			# count the windows of each split, one file at a time
+			utils.log('Counting training windows...', args.verbose)
+			num_train_windows = data_utils.count_midi_windows(midi_files[0:val_split_index],
+														 args.window_size, args.ignore_empty,
+														 args.n_jobs, cache)
+			num_val_windows = data_utils.count_midi_windows(midi_files[val_split_index:],
+													   args.window_size, args.ignore_empty,
+													   args.n_jobs, cache)
+
+			# use generators to lazy load train/validation data, ensuring that the
+			# user doesn't have to load all midi files into RAM at once
+			train_generator = data_utils.get_data_generator(midi_files[0:val_split_index],
+													   num_threads=args.n_jobs,
+													   max_files_in_ram=args.max_files_in_ram,
+													   cache=cache,
+													   **data_kwargs)
+
+			val_generator = data_utils.get_data_generator(midi_files[val_split_index:],
+													 num_threads=args.n_jobs,
+													 max_files_in_ram=args.max_files_in_ram,
+													 cache=cache,
+													 **data_kwargs)
 
 	# Load model
 	model, epoch = get_model(args)
@@ -303,16 +410,26 @@ def main():
 	callbacks = get_callbacks(experiment_dir)
 
 	print('fitting model...')
-	magic_number = 500
+	# one epoch is one full pass over the training windows
+	if use_sequences:
+		steps_per_epoch, validation_steps = len(train_generator), len(val_generator)
+	else:
+		steps_per_epoch = max(num_train_windows // args.batch_size, 1)
+		validation_steps = max(num_val_windows // args.batch_size, 1)
+	utils.log('{} steps per epoch, {} validation steps'.format(steps_per_epoch, validation_steps),
+			  args.verbose)
 	start_time = time.time()
 	model.fit_generator(train_generator,
-						steps_per_epoch= num_tracks * magic_number / args.batch_size,
+						steps_per_epoch=steps_per_epoch,
 						epochs=args.num_epochs,
 						validation_data=val_generator,
-						validation_steps= num_tracks * .1 * magic_number / args.batch_size,
+						validation_steps=validation_steps,
 						verbose=1,
 						callbacks=callbacks,
-						initial_epoch=epoch)
+						initial_epoch=epoch,
+						workers=args.workers if use_sequences else 1,
+						use_multiprocessing=args.use_multiprocessing,
+						max_queue_size=max(args.prefetch_depth, 1))
 	utils.log('Finished in {:.2f} seconds'.format(time.time() - start_time), args.verbose)
 
 